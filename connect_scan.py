@@ -4,15 +4,270 @@
 
 Port scan some hosts by attempting to establish a TCP connection.
 
-TODO:
-    Add threading, scapy, or both. This takes way too long with lots of ports
-    or hosts because of the "long" timeout and sequential scan.
+By default probes run concurrently on an asyncio event loop with
+non-blocking sockets, bounded by a global and a per-host concurrency limit,
+and open ports are printed as they're found. Each host's connect timeout is
+learned from its round trip times, and probes that time out are retried.
+With --checkpoint, an interrupted scan can be carried on with --resume.
+The original one-at-a-time scan is still there behind --sequential.
 """
+import os
 import sys
+import json
+import errno
+import time
 import argparse
+import asyncio
 import socket
 import random
+import ipaddress
+import multiprocessing
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from itertools import count, islice
+from queue import Empty
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+class RangeSet(object):
+    """A set of integers stored as sorted, non-overlapping ranges.
+
+    Membership, size and indexing (the n-th smallest member) are all
+    O(log ranges), and iterating never builds a list, so '1-65535' costs
+    the same as '80'.
+
+    >>> ports = RangeSet([(80, 81), (1, 1025)])
+    >>> assert len(ports) == 1024 and ports[79] == 80 and 1024 in ports
+
+    len() can't be more than sys.maxsize, which an IPv6 /64 is, so what
+    works on sets of any size uses size() instead.
+    """
+    def __init__(self, ranges=()):
+        """Build the set from (start, stop) pairs, stop exclusive, in any
+        order and overlapping or not."""
+        self._starts = []
+        self._stops = []
+        for start, stop in sorted(ranges):
+            if start >= stop:
+                continue
+            if self._stops and start <= self._stops[-1]:
+                self._stops[-1] = max(self._stops[-1], stop)
+            else:
+                self._starts.append(start)
+                self._stops.append(stop)
+
+        # _offsets[i] is how many members come before range i.
+        self._offsets = [0]
+        for start, stop in zip(self._starts, self._stops):
+            self._offsets.append(self._offsets[-1] + stop - start)
+
+    def size(self):
+        """Return the number of members, however many there are."""
+        return self._offsets[-1]
+
+    def __len__(self):
+        return self.size()
+
+    def __contains__(self, value):
+        index = bisect_right(self._starts, value) - 1
+        return index >= 0 and value < self._stops[index]
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size():
+            raise IndexError('RangeSet index out of range')
+        range_index = bisect_right(self._offsets, index) - 1
+        return self._starts[range_index] + index - self._offsets[range_index]
+
+    def __iter__(self):
+        for start, stop in zip(self._starts, self._stops):
+            yield from range(start, stop)
+
+    def shuffled(self, seed=None):
+        """Return an iterable over the members in a pseudo-random order,
+        the same order every time it's iterated."""
+        return Shuffled(self, seed)
+
+class Shuffled(object):
+    """A sequence (with a size() method) iterated in the pseudo-random order
+    of permutation().
+
+    With a start and step, only every step-th item of that order from the
+    start-th is iterated, like islice(), but the items skipped are never
+    looked up in the sequence.
+    """
+    def __init__(self, sequence, seed=None, start=0, step=1):
+        self.sequence = sequence
+        self.seed = random.randrange(1 << 32) if seed is None else seed
+        self.start = start
+        self.step = step
+
+    def size(self):
+        """Return the number of items iterated, however many there are."""
+        return max(0, -(-(self.sequence.size() - self.start) // self.step))
+
+    def __len__(self):
+        return self.size()
+
+    def __iter__(self):
+        sequence = self.sequence
+        indices = permutation(sequence.size(), random.Random(self.seed))
+        if self.start or self.step != 1:
+            indices = islice(indices, self.start, None, self.step)
+        return (sequence[index] for index in indices)
+
+def permutation(length, rng=random):
+    """Lazily yield every integer in range(length) exactly once, in a
+    pseudo-random order, in constant memory.
+
+    A linear congruential generator modulo a power of two (with an odd
+    increment and a multiplier of 1 mod 4) visits every integer below the
+    modulus once per period. Scrambling its output with a fixed bijection
+    hides the LCG's regular low bits, and values past length are skipped
+    ("cycle walking"), which at most doubles the steps taken.
+    """
+    if length <= 0:
+        return
+
+    bits = max(2, (length - 1).bit_length())
+    mask = (1 << bits) - 1
+    shift = (bits + 1) // 2
+    multiplier = rng.randrange(1 << (bits - 2)) * 4 + 1
+    increment = rng.randrange(1 << (bits - 1)) * 2 + 1
+    scramble = rng.randrange(1 << (bits - 1)) * 2 + 1
+    state = rng.randrange(1 << bits)
+
+    for _ in range(1 << bits):
+        state = (multiplier * state + increment) & mask
+        value = state ^ (state >> shift)
+        value = (value * scramble) & mask
+        value ^= value >> shift
+        if value < length:
+            yield value
+
+class Product(object):
+    """The pairs (host, port) of every host with every port, as a sequence.
+
+    Pairs are ordered port-major: the first port on every host, then the
+    second port on every host and so on, so that iterating it in order
+    never probes the same host twice in a row (if there's more than one).
+    shuffled() makes no such promise.
+    """
+    def __init__(self, hosts, ports):
+        self.hosts = hosts
+        self.ports = ports
+
+    def size(self):
+        """Return the number of pairs, however many there are."""
+        return self.hosts.size() * self.ports.size()
+
+    def __len__(self):
+        return self.size()
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size():
+            raise IndexError('Product index out of range')
+        port_index, host_index = divmod(index, self.hosts.size())
+        return self.hosts[host_index], self.ports[port_index]
+
+    def __iter__(self):
+        for port in self.ports:
+            for host in self.hosts:
+                yield host, port
+
+    def shuffled(self, seed=None, start=0, step=1):
+        """Return an iterable over the pairs in a pseudo-random order (or
+        every step-th of them from the start-th, see Shuffled)."""
+        return Shuffled(self, seed, start, step)
+
+class Targets(object):
+    """The hosts named on the command line, as a sequence of strings.
+
+    Host names are kept as they are. IP addresses, CIDR blocks ('10.0.0.0/16')
+    and address ranges ('10.0.0.1-10.0.3.254'), IPv4 or IPv6, are kept as
+    RangeSets of integers and only turned back into strings when indexed, so
+    a /8 takes no more memory than a single address.
+    """
+    def __init__(self, specs):
+        self.names = []
+        ranges = {4: [], 6: []}
+        for spec in specs:
+            address_range = parse_address_range(spec)
+            if address_range is None:
+                if spec not in self.names:
+                    self.names.append(spec)
+            else:
+                version, start, stop = address_range
+                ranges[version].append((start, stop))
+        self.ipv4 = RangeSet(ranges[4])
+        self.ipv6 = RangeSet(ranges[6])
+
+    def size(self):
+        """Return the number of hosts, however many there are."""
+        return len(self.names) + self.ipv4.size() + self.ipv6.size()
+
+    def __len__(self):
+        return self.size()
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size():
+            raise IndexError('Targets index out of range')
+        if index < len(self.names):
+            return self.names[index]
+        index -= len(self.names)
+        if index < self.ipv4.size():
+            return str(ipaddress.IPv4Address(self.ipv4[index]))
+        return str(ipaddress.IPv6Address(
+            self.ipv6[index - self.ipv4.size()]))
+
+    def __iter__(self):
+        yield from self.names
+        for address in self.ipv4:
+            yield str(ipaddress.IPv4Address(address))
+        for address in self.ipv6:
+            yield str(ipaddress.IPv6Address(address))
+
+def parse_address_range(spec):
+    """Parse an IP address, CIDR block or 'first-last' address range.
+
+    Return (tuple): (version, start, stop) with the addresses as integers,
+        stop exclusive, or None if spec isn't any of those (ie. it's a host
+        name).
+    """
+    try:
+        if '/' in spec:
+            network = ipaddress.ip_network(spec, strict=False)
+            start = int(network.network_address)
+            return network.version, start, start + network.num_addresses
+        if '-' in spec:
+            first, last = (ipaddress.ip_address(address)
+                           for address in spec.split('-', 1))
+            if first.version != last.version or first > last:
+                return None
+            return first.version, int(first), int(last) + 1
+        address = ipaddress.ip_address(spec)
+        return address.version, int(address), int(address) + 1
+    except ValueError:
+        return None
+
+def parse_ports(spec):
+    """Parse a port spec like '22,80,8000-8100' into a RangeSet, skipping
+    anything that isn't a port number or a range of them."""
+    ranges = []
+    for port in spec.split(','):
+        if '-' in port:
+            low, *_, high = port.split('-')
+            if not is_portnum(low) or not is_portnum(high):
+                continue
+            ranges.append((int(low), int(high) + 1))
+        else:
+            if is_portnum(port):
+                ranges.append((int(port), int(port) + 1))
+    return RangeSet(ranges)
 
 @contextmanager
 def open_tcp_connection(host, port, timeout=0.4):
@@ -49,6 +304,725 @@ def is_port_up(host, port):
             connection_success = True
     return connection_success
 
+async def probe_port(address, port, timeout=0.4, family=socket.AF_INET):
+    """Attempt to connect to address on port over TCP without blocking the
+    event loop.
+
+    Args:
+        address (str): The IP address of the host to connect to.
+        port (int): The port to connect to on host.
+        timeout (float): Seconds to wait for the connection.
+        family (int): The address family of address.
+
+    Return (tuple):
+        state (str): 'open', 'closed' (refused), 'filtered' (timed out) or
+            'error' (any other failure, eg. unreachable).
+        seconds (float): How long it took to find out.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+
+    # Out of file descriptors is our problem, not the host's: wait for
+    # other probes to close theirs.
+    while True:
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            break
+        except OSError as error:
+            if error.errno not in (errno.EMFILE, errno.ENFILE):
+                return 'error', time.perf_counter() - start
+            await asyncio.sleep(0.01)
+            start = time.perf_counter()
+    sock.setblocking(False)
+
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, (address, port)),
+                               timeout)
+    except ConnectionRefusedError:
+        state = 'closed'
+    except asyncio.TimeoutError:
+        state = 'filtered'
+    except OSError:
+        state = 'error'
+    else:
+        state = 'open'
+    finally:
+        sock.close()
+
+    return state, time.perf_counter() - start
+
+def fd_limit(reserve=64):
+    """Return how many sockets can be open at once under this process's
+    RLIMIT_NOFILE, keeping reserve file descriptors for everything else, or
+    None if there's no limit (or no way to find it out)."""
+    if resource is None:
+        return None
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(1, soft - reserve)
+
+class RttEstimator(object):
+    """Connect timeout for one host, learned from the round trips observed
+    so far the way TCP computes its retransmission timeout (RFC 6298):
+    a smoothed mean plus four times the smoothed mean deviation, clamped to
+    [minimum, maximum]. Until there's a sample, the timeout is initial.
+    """
+    def __init__(self, initial=0.4, minimum=0.05, maximum=3.0):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    @property
+    def timeout(self):
+        """Seconds to wait for the next connection."""
+        if self.srtt is None:
+            timeout = self.initial
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        return min(max(timeout, self.minimum), self.maximum)
+
+    def update(self, sample):
+        """Take a round trip time (in seconds) into account."""
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+class RateLimiter(object):
+    """Token bucket: acquire() lets at most rate callers per second through,
+    with bursts of up to burst."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate / 10)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    async def acquire(self):
+        """Wait for a token."""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Done(object):
+    """A set of work item numbers (seqs), kept as a low-water mark that every
+    seq below is done, and a set of the seqs done above it. Work finishes
+    roughly in order, so the set stays about as small as the number of
+    probes in flight.
+    """
+    def __init__(self, low_water=0, above=()):
+        self.low_water = low_water
+        self.above = set(above)
+
+    def __contains__(self, seq):
+        return seq < self.low_water or seq in self.above
+
+    def add(self, seq):
+        """Mark seq done."""
+        if seq < self.low_water:
+            return
+        self.above.add(seq)
+        while self.low_water in self.above:
+            self.above.remove(self.low_water)
+            self.low_water += 1
+
+class Checkpoint(object):
+    """How far a scan has got, saved as JSON to filename every interval
+    seconds so that it can be resumed after being interrupted.
+
+    The scan is identified by its hosts and ports specs and the seed of its
+    order, which is what makes seqs mean the same thing from one run to the
+    next. Alongside which seqs are done, the open ports found so far are
+    kept as report() records.
+    """
+    def __init__(self, filename, hosts, ports, seed, interval=10):
+        self.filename = filename
+        self.hosts = hosts
+        self.ports = ports
+        self.seed = seed
+        self.interval = interval
+        self.done = Done()
+        self.results = []
+        self._last_save = time.monotonic()
+
+    @classmethod
+    def load(cls, filename, interval=10):
+        """Return the Checkpoint saved in filename."""
+        with open(filename) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        checkpoint = cls(filename, saved['hosts'], saved['ports'],
+                         saved['seed'], interval)
+        checkpoint.done = Done(saved['low_water'], saved['done'])
+        checkpoint.results = [tuple(record) for record in saved['results']]
+        return checkpoint
+
+    def save(self):
+        """Write the checkpoint to its file, atomically."""
+        saved = {'hosts': self.hosts, 'ports': self.ports,
+                 'seed': self.seed, 'low_water': self.done.low_water,
+                 'done': sorted(self.done.above), 'results': self.results}
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as checkpoint_file:
+            json.dump(saved, checkpoint_file)
+        os.replace(tmp_filename, self.filename)
+        self._last_save = time.monotonic()
+
+    def add(self, seq, host, address, port, state, seconds):
+        """Record a report() record, saving if it's been interval seconds
+        since the last save."""
+        self.done.add(seq)
+        if state == 'open':
+            self.results.append((seq, host, address, port, state, seconds))
+        if time.monotonic() - self._last_save >= self.interval:
+            self.save()
+
+class Resolver(object):
+    """Asynchronous host name resolution, cached for ttl seconds.
+
+    Lookups run getaddrinfo() on a thread pool of the resolver's own, up to
+    concurrency at once (the event loop's default executor has only a few
+    threads), and callers asking for a name that's already being looked up
+    wait for that lookup instead of starting another. Failures are cached
+    too. IP addresses are returned as they are. close() shuts the thread
+    pool down.
+
+    Attributes:
+        lookups (int): getaddrinfo() calls made
+        hits (int): resolve() calls answered from the cache
+    """
+    def __init__(self, ttl=300, family=socket.AF_UNSPEC, concurrency=64,
+                 known=None):
+        """
+        Args:
+            ttl (float): Seconds to cache answers for.
+            family (int): The address family to resolve names to.
+            concurrency (int): Lookups in flight at once.
+            known (dict): Answers (host: address or None) to start with,
+                which never expire.
+        """
+        self.ttl = ttl
+        self.family = family
+        self.concurrency = concurrency
+        self.lookups = 0
+        self.hits = 0
+        self._cache = {host: (float('inf'), address)
+                       for host, address in (known or {}).items()}
+        self._pending = {}
+        self._executor = None
+
+    def resolve_nowait(self, host):
+        """Return an IP address of host (or None if it can't be resolved)
+        if that's known already, or else an asyncio.Future of it, starting
+        a lookup unless there's one going."""
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            return host
+
+        entry = self._cache.get(host)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        pending = self._pending.get(host)
+        if pending is None:
+            pending = asyncio.ensure_future(self._lookup(host))
+            self._pending[host] = pending
+            pending.add_done_callback(
+                lambda _: self._pending.pop(host, None))
+        return pending
+
+    async def resolve(self, host):
+        """Return an IP address of host, or None if it can't be resolved."""
+        address = self.resolve_nowait(host)
+        if isinstance(address, asyncio.Future):
+            # shield(): one caller being cancelled mustn't cancel the lookup
+            # for everyone else waiting on it.
+            return await asyncio.shield(address)
+        return address
+
+    async def _lookup(self, host):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix='Resolver')
+        loop = asyncio.get_running_loop()
+        self.lookups += 1
+        try:
+            infos = await loop.run_in_executor(
+                self._executor, socket.getaddrinfo, host, None, self.family,
+                socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError):
+            address = None
+        else:
+            # getaddrinfo() sorts them by preference (RFC 6724).
+            address = infos[0][4][0] if infos else None
+        self._cache[host] = (time.monotonic() + self.ttl, address)
+        return address
+
+    def close(self):
+        """Shut the lookup threads down, dropping lookups not started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def prefetch(self, hosts):
+        """Start resolving every one of hosts in the background."""
+        return [asyncio.ensure_future(self.resolve(host)) for host in hosts]
+
+    async def resolve_all(self, hosts):
+        """Return a dict of every one of hosts to its address (or None)."""
+        addresses = await asyncio.gather(*(self.resolve(host)
+                                           for host in hosts))
+        return dict(zip(hosts, addresses))
+
+async def scan(work, report, concurrency=500, per_host=100, timeout=0.4,
+               min_timeout=0.05, max_timeout=3.0, retries=1, rate=None,
+               resolver=None, first_seq=0, seq_step=1, skip=(), gate=None,
+               max_estimators=1 << 16):
+    """Probe every (host, port) in work, at most concurrency at a time
+    overall and per_host at a time on any one address.
+
+    Hosts are resolved by resolver as their first port comes up, so probing
+    starts as soon as any host has an address rather than once all of them
+    have one. A pair whose host is still being looked up is set aside until
+    the lookup finishes rather than holding up one of the concurrency
+    slots, so a few slow names can't stall the scan. Ports on hosts that
+    can't be resolved are reported with an address of None and a state of
+    'unresolved'.
+
+    Every item of work is numbered in the order it's taken, from first_seq
+    counting up by seq_step, and reported with that number. Items whose
+    number is in skip are passed over.
+
+    Each address gets its own RttEstimator: answers (open or closed) teach
+    it how long that host takes to respond, so a LAN host soon gets a short
+    timeout and a distant one a long one. A probe that times out is retried
+    up to retries times, doubling the timeout each time.
+
+    Memory use doesn't grow with the number of addresses: an address's
+    per_host semaphore only exists while it has probes waiting or in
+    flight, and only the max_estimators most recently probed addresses
+    keep their RttEstimator (a few hundred bytes each).
+
+    Args:
+        work (iterable): (host, port) tuples. It's consumed lazily, so it
+            can be a generator over a huge space.
+        report (callable): Called with (seq, host, address, port, state,
+            seconds) as each probe completes.
+        concurrency (int): Probes in flight at once, overall. Capped by
+            fd_limit().
+        per_host (int): Probes in flight at once on any one address.
+        timeout (float): Seconds to wait for a host's first connections.
+        min_timeout (float): Least the learned timeout can be.
+        max_timeout (float): Most the learned timeout can be.
+        retries (int): Extra attempts for probes that time out.
+        rate (float): Most probes to start per second, overall (no limit if
+            None).
+        resolver (Resolver): Resolves the hosts (a new one if None).
+        first_seq (int): The number of the first item of work.
+        seq_step (int): What to add to the number for each next item.
+        skip (container): Numbers of items not to probe (eg. a Done).
+        gate (coroutine function): Awaited with each item's number before
+            it's probed, to hold items back (optional).
+        max_estimators (int): Most addresses to remember round trip times
+            for.
+    """
+    # More probes in flight than file descriptors would only wait on each
+    # other for sockets.
+    limit = fd_limit()
+    if limit is not None:
+        concurrency = min(concurrency, limit)
+
+    # address: [Semaphore, probes waiting on it or holding it]
+    host_limits = {}
+    # address: RttEstimator, least recently probed first
+    estimators = OrderedDict()
+    limiter = RateLimiter(rate) if rate else None
+    own_resolver = resolver is None
+    resolver = resolver or Resolver()
+    work = zip(count(first_seq, seq_step), work)
+    # (seq, host, address, port) of pairs set aside for a lookup that's
+    # since finished, how many are still waiting on one, and an event set
+    # when one finishes.
+    resolved = deque()
+    waiting = 0
+    lookup_done = asyncio.Event()
+
+    def set_aside(seq, host, port, lookup):
+        nonlocal waiting
+        waiting += 1
+
+        def done(_):
+            nonlocal waiting
+            waiting -= 1
+            address = (None if lookup.cancelled() or lookup.exception()
+                       else lookup.result())
+            resolved.append((seq, host, address, port))
+            lookup_done.set()
+
+        lookup.add_done_callback(done)
+
+    def get_estimator(address):
+        estimator = estimators.get(address)
+        if estimator is None:
+            if len(estimators) >= max_estimators:
+                estimators.popitem(last=False)
+            estimator = estimators[address] = RttEstimator(
+                timeout, min_timeout, max_timeout)
+        else:
+            estimators.move_to_end(address)
+        return estimator
+
+    async def probe(address, port):
+        estimator = get_estimator(address)
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        probe_timeout = estimator.timeout
+        for _ in range(retries + 1):
+            if limiter is not None:
+                await limiter.acquire()
+            state, seconds = await probe_port(address, port, probe_timeout,
+                                              family)
+            if state in ('open', 'closed'):
+                estimator.update(seconds)
+            if state != 'filtered':
+                break
+            probe_timeout = min(probe_timeout * 2, max_timeout)
+        return state, seconds
+
+    async def worker():
+        # Every worker pulls from the same iterator; next() never awaits, so
+        # no two workers can get the same item.
+        while True:
+            if resolved:
+                seq, host, address, port = resolved.popleft()
+            else:
+                item = next(work, None)
+                if item is None:
+                    if not waiting:
+                        return
+                    lookup_done.clear()
+                    await lookup_done.wait()
+                    continue
+                seq, (host, port) = item
+                if seq in skip:
+                    continue
+                if gate is not None:
+                    await gate(seq)
+                address = resolver.resolve_nowait(host)
+                if isinstance(address, asyncio.Future):
+                    set_aside(seq, host, port, address)
+                    continue
+            if address is None:
+                report(seq, host, None, port, 'unresolved', 0.0)
+                continue
+            host_limit = host_limits.get(address)
+            if host_limit is None:
+                host_limit = host_limits[address] = [
+                    asyncio.Semaphore(per_host), 0]
+            host_limit[1] += 1
+            try:
+                async with host_limit[0]:
+                    state, seconds = await probe(address, port)
+            finally:
+                host_limit[1] -= 1
+                if not host_limit[1]:
+                    del host_limits[address]
+            report(seq, host, address, port, state, seconds)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        if own_resolver:
+            resolver.close()
+
+def _scan_shard(index, workers, hosts, ports, seed, addresses, results,
+                next_due, window, scan_options):
+    """Accessory to scan_sharded(), run in each worker process.
+
+    Scan every workers-th (host, port) pair from the index-th, sending
+    ('results', index, [(seq, host, address, port, state, seconds), ...])
+    batches to the results queue and ('done', index, None) at the end.
+    Pairs numbered window or more past next_due.value (the next seq the
+    parent is waiting for) are held back until it catches up.
+    """
+    batch = []
+    last_flush = time.monotonic()
+
+    def flush():
+        nonlocal batch, last_flush
+        results.put(('results', index, batch))
+        batch = []
+        last_flush = time.monotonic()
+
+    def report(*record):
+        batch.append(record)
+        if len(batch) >= 256 or time.monotonic() - last_flush > 0.5:
+            flush()
+
+    async def gate(seq):
+        while seq >= next_due.value + window:
+            await asyncio.sleep(0.01)
+
+    async def flusher():
+        # The parent may be waiting on a record in a batch that's not full,
+        # from a worker whose probes are all slow or held back.
+        while True:
+            await asyncio.sleep(0.5)
+            if batch:
+                flush()
+
+    async def run():
+        resolver = Resolver(known=addresses)
+        shard = Product(hosts, ports).shuffled(seed, index, workers)
+        flushing = asyncio.ensure_future(flusher())
+        try:
+            await scan(shard, report, resolver=resolver, first_seq=index,
+                       seq_step=workers, gate=gate, **scan_options)
+        finally:
+            flushing.cancel()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        return
+    if batch:
+        flush()
+    results.put(('done', index, None))
+
+def print_progress(counts, seconds, out=sys.stderr):
+    """Print how many probes each worker has made and how fast."""
+    for index, probes in enumerate(counts):
+        print('worker {}: {} probes, {:.0f}/s'.format(
+            index, probes, probes / seconds if seconds else 0), file=out)
+    print('total: {} probes, {:.0f}/s'.format(
+        sum(counts), sum(counts) / seconds if seconds else 0),
+          file=out, flush=True)
+
+def scan_sharded(hosts, ports, report, workers, seed=None, dns_ttl=300,
+                 family=socket.AF_UNSPEC, progress_interval=5, skip=(),
+                 window=None, **scan_options):
+    """Scan hosts like scan(), split across workers processes each running
+    an event loop of their own.
+
+    The pairs are numbered in the order of Product(hosts, ports).shuffled(seed)
+    and worker i scans the pairs numbered i, i + workers, i + 2 * workers...
+    Host names are resolved once, up front, so that every worker probes the
+    same addresses. Results are put back in pair order before being passed
+    to report(), so the output is the same whatever the number of workers.
+    Each worker's progress and throughput is printed to stderr every
+    progress_interval seconds and at the end. Limits in scan_options (eg.
+    concurrency and rate) apply to each worker separately.
+
+    Results that arrive ahead of their turn wait in a reorder buffer. To
+    keep it bounded, no worker probes a pair numbered window or more past
+    the next one due, so a worker stuck on slow (eg. filtered) ports holds
+    the others back rather than letting their results pile up: at most
+    window results are ever waiting.
+
+    Args:
+        hosts (Targets): The hosts to connect to.
+        ports (RangeSet): The ports on hosts to connect to.
+        report (callable): Called like scan()'s report, in seq order.
+        workers (int): Number of processes to split the scan across.
+        seed (int): Seed for the order of the pairs (random if None).
+        dns_ttl (float): See scan_hosts().
+        family (int): See scan_hosts().
+        progress_interval (float): Seconds between progress reports.
+        skip (container): See scan().
+        window (int): How far past the next result due workers may get.
+            The default, 65536 results (a few MB), lets the others carry on
+            for several seconds of the slowest probe at thousands of probes
+            per second, or four times what they all have in flight if
+            that's more.
+        scan_options: Passed on to scan() in each worker.
+    """
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    if window is None:
+        window = max(1 << 16,
+                     4 * workers * scan_options.get('concurrency', 500))
+    resolver = Resolver(dns_ttl, family)
+    try:
+        addresses = asyncio.run(resolver.resolve_all(hosts.names))
+    finally:
+        resolver.close()
+
+    results = multiprocessing.Queue(maxsize=workers * 16)
+    # The seq of the next record due, for the workers' gates.
+    next_due = multiprocessing.RawValue('q', 0)
+    processes = [multiprocessing.Process(
+        target=_scan_shard, daemon=True,
+        args=(index, workers, hosts, ports, seed, addresses, results,
+              next_due, window, dict(scan_options, skip=skip)))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Records that arrived ahead of the next one due, by seq.
+    pending = {}
+    next_seq = 0
+    running = set(range(workers))
+    # Workers seen to have exited without sending 'done', as of the last
+    # time the queue came up empty.
+    exited = set()
+    counts = [0] * workers
+    start = last_progress = time.perf_counter()
+
+    try:
+        while running:
+            try:
+                kind, index, records = results.get(timeout=1)
+            except Empty:
+                # A worker that exits without sending 'done' (killed,
+                # crashed or interrupted on its own) would be waited for
+                # forever, whatever its exit code. Its last messages can
+                # still be on their way, so it gets one more timeout.
+                for index in running:
+                    exitcode = processes[index].exitcode
+                    if exitcode is None:
+                        continue
+                    if index in exited:
+                        raise RuntimeError(
+                            'worker {} exited with code {} before finishing'
+                            .format(index, exitcode))
+                    exited.add(index)
+            else:
+                if kind == 'done':
+                    running.discard(index)
+                else:
+                    counts[index] += len(records)
+                    for record in records:
+                        pending[record[0]] = record
+                    while next_seq in pending or next_seq in skip:
+                        if next_seq in pending:
+                            report(*pending.pop(next_seq))
+                        next_seq += 1
+                    next_due.value = next_seq
+
+            now = time.perf_counter()
+            if now - last_progress >= progress_interval:
+                print_progress(counts, now - start)
+                last_progress = now
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    for seq in sorted(pending):
+        report(*pending[seq])
+    print_progress(counts, time.perf_counter() - start)
+
+def scan_hosts(hosts, ports, resolve_names=True, seed=None, dns_ttl=300,
+               family=socket.AF_UNSPEC, workers=1, output='text',
+               checkpoint=None, **scan_options):
+    """Resolve a list of hosts by name to IP addresses and scan their TCP
+    ports concurrently, printing open ports as they're found.
+
+    Every host name is looked up concurrently as soon as the scan starts,
+    and its ports are probed as soon as it has an address.
+
+    Every (host, port) pair is visited once in a pseudo-random order that's
+    generated lazily, so probes are spread over all of the hosts and memory
+    use doesn't depend on how many pairs there are.
+
+    With a checkpoint, pairs it has as done are skipped and the open ports
+    it found before are printed again first.
+
+    Args:
+        hosts (Targets): The hosts to connect to.
+        ports (RangeSet): The ports on hosts to connect to.
+        resolve_names (bool): Print the address each host resolved to.
+        seed (int): Seed for the order of the pairs (random if None).
+        dns_ttl (float): Seconds to cache host names for.
+        family (int): socket.AF_INET or AF_INET6 to only resolve host names
+            to IPv4 or IPv6 addresses, AF_UNSPEC for either.
+        workers (int): Split the scan across this many processes with
+            scan_sharded() if more than 1.
+        output (str): 'text' to print open ports, 'jsonl' to print a JSON
+            record of every probe.
+        checkpoint (Checkpoint): Where to record progress (optional). Its
+            seed is used rather than seed.
+        scan_options: Passed on to scan().
+
+    Return: 0 once every pair has been scanned, 130 if interrupted with
+        Ctrl-C (after saving the checkpoint).
+    """
+    unresolved = set()
+
+    def show(seq, host, address, port, state, seconds):
+        if output == 'jsonl':
+            print(json.dumps({'seq': seq, 'host': host, 'address': address,
+                              'port': port, 'state': state,
+                              'seconds': round(seconds, 6)}), flush=True)
+            return
+        if state == 'unresolved' and host not in unresolved:
+            unresolved.add(host)
+            print('Unable to resolve host ' + host)
+        if state != 'open':
+            return
+        if resolve_names:
+            print(host, '[' + address + ']:', '[' + str(port) + ']',
+                  flush=True)
+        else:
+            print(host + ':', '[' + str(port) + ']', flush=True)
+
+    if checkpoint is None:
+        report = show
+        skip = ()
+    else:
+        def report(*record):
+            show(*record)
+            checkpoint.add(*record)
+
+        for record in checkpoint.results:
+            show(*record)
+        seed = checkpoint.seed
+        # A copy, so that what's skipped doesn't change as the scan goes.
+        skip = Done(checkpoint.done.low_water, checkpoint.done.above)
+
+    async def run():
+        resolver = Resolver(dns_ttl, family)
+        try:
+            resolver.prefetch(hosts.names)
+            await scan(Product(hosts, ports).shuffled(seed), report,
+                       resolver=resolver, skip=skip, **scan_options)
+        finally:
+            resolver.close()
+
+    try:
+        try:
+            if workers > 1:
+                scan_sharded(hosts, ports, report, workers, seed, dns_ttl,
+                             family, skip=skip, **scan_options)
+            else:
+                asyncio.run(run())
+        finally:
+            if checkpoint is not None:
+                checkpoint.save()
+    except KeyboardInterrupt:
+        if checkpoint is None:
+            print('Interrupted', file=sys.stderr)
+        else:
+            print('Interrupted; carry on with --resume --checkpoint ' +
+                  checkpoint.filename, file=sys.stderr)
+        return 130
+
+    return 0
+
 def resolve_name(host):
     """Resolve the text name of a host to an address on the Internet.
 
@@ -68,8 +1042,8 @@ def lookup_hosts(hosts, ports, resolve_names=True):
     to them on TCP ports.
 
     Args:
-        hosts (list): The hosts to connect to.
-        ports (list): The ports on hosts to connect to.
+        hosts (iterable): The hosts to connect to.
+        ports (iterable): The ports on hosts to connect to.
     """
     for host in hosts:
         if resolve_names:
@@ -104,35 +1078,109 @@ def main(argv):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description=("Scan some ports on some hosts"))
-    parser.add_argument('host', nargs='+', help='hostname to scan')
+    parser.add_argument('host', nargs='+',
+                        help='hostname, IP address, CIDR block (10.0.0.0/16) '
+                             'or address range (10.0.0.1-10.0.3.254) to scan')
     parser.add_argument('-p', '--ports', type=str, default='80,443',
                         help='Comma separated list of ports to scan')
     parser.add_argument('--no-dns', '-n', action='store_false', default=True,
                         help='Do not resolve host names using DNS')
+    parser.add_argument('-4', dest='family', action='store_const',
+                        const=socket.AF_INET, default=socket.AF_UNSPEC,
+                        help='Only resolve host names to IPv4 addresses')
+    parser.add_argument('-6', dest='family', action='store_const',
+                        const=socket.AF_INET6,
+                        help='Only resolve host names to IPv6 addresses')
+    parser.add_argument('--dns-ttl', type=float, default=300,
+                        help='Seconds to cache host names for')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Processes to split the scan across (0: one '
+                             'per CPU)')
+    parser.add_argument('--sequential', action='store_true',
+                        help='Probe one port at a time, without asyncio')
+    parser.add_argument('--concurrency', '-c', type=int, default=500,
+                        help='Probes in flight at once, overall')
+    parser.add_argument('--per-host', type=int, default=100,
+                        help='Probes in flight at once on any one host')
+    parser.add_argument('--timeout', '-t', type=float, default=0.4,
+                        help='Seconds to wait for connections to a host '
+                             'until its round trip time has been measured')
+    parser.add_argument('--min-timeout', type=float, default=0.05,
+                        help='Least a learned per-host timeout can be')
+    parser.add_argument('--max-timeout', type=float, default=3.0,
+                        help='Most a learned per-host timeout can be')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Extra attempts for probes that time out')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Most probes to start per second (default: '
+                             'no limit)')
+    parser.add_argument('--output', choices=['text', 'jsonl'],
+                        default='text',
+                        help='Print open ports as text, or a JSON record of '
+                             'every probe')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the order of the probes (default: '
+                             'random)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='Save the progress of the scan to FILE')
+    parser.add_argument('--checkpoint-interval', type=float, default=10,
+                        help='Seconds between saves of the checkpoint')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on from the --checkpoint FILE, if there '
+                             'is one')
     args = parser.parse_args(argv)
 
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+    if args.sequential and (args.checkpoint or args.resume or
+                            args.output != 'text'):
+        parser.error('--checkpoint, --resume and --output jsonl can\'t be '
+                     'used with --sequential')
+
+    limit = fd_limit()
+    if limit is not None and args.concurrency > limit:
+        print('Limiting concurrency to {} for want of file descriptors '
+              '(see ulimit -n)'.format(limit), file=sys.stderr)
+
     # Parse ports
-    ports = []
-    for port in args.ports.split(','):
-        if '-' in port:
-            low, *_, high = port.split('-')
-            if not is_portnum(low) or not is_portnum(high):
-                continue
-            for _ in range(int(low), int(high) + 1):
-                if _ not in ports:
-                    ports.append(_)
-        else:
-            if is_portnum(port) and int(port) not in ports:
-                ports.append(int(port))
+    ports = parse_ports(args.ports)
 
     if not ports:
         print('No ports specified')
         sys.exit(1)
 
-    random.shuffle(ports)
+    hosts = Targets(args.host)
+
+    # Load or start the checkpoint
+    checkpoint = None
+    if args.resume and os.path.isfile(args.checkpoint):
+        checkpoint = Checkpoint.load(args.checkpoint,
+                                     args.checkpoint_interval)
+        if checkpoint.hosts != args.host or checkpoint.ports != args.ports:
+            print('Checkpoint ' + args.checkpoint + ' is for a different '
+                  'scan: ' + ' '.join(checkpoint.hosts) + ' -p ' +
+                  checkpoint.ports)
+            sys.exit(1)
+    elif args.checkpoint:
+        seed = random.randrange(1 << 32) if args.seed is None else args.seed
+        checkpoint = Checkpoint(args.checkpoint, args.host, args.ports, seed,
+                                args.checkpoint_interval)
 
     # Scan hosts
-    lookup_hosts(args.host, ports, resolve_names=args.no_dns)
+    if args.sequential:
+        lookup_hosts(hosts, ports.shuffled(args.seed),
+                     resolve_names=args.no_dns)
+    else:
+        return scan_hosts(hosts, ports, resolve_names=args.no_dns,
+                          concurrency=args.concurrency,
+                          per_host=args.per_host, timeout=args.timeout,
+                          min_timeout=args.min_timeout,
+                          max_timeout=args.max_timeout, retries=args.retries,
+                          rate=args.rate, dns_ttl=args.dns_ttl,
+                          family=args.family,
+                          workers=args.workers or os.cpu_count(),
+                          seed=args.seed, output=args.output,
+                          checkpoint=checkpoint)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
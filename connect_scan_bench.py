@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark connect_scan.py against a stand-in target on localhost.
+
+Opens a mix of ports on 127.0.0.1:
+    open: listening, with a thread accepting (and closing) connections
+    closed: nothing listening, so connections are refused
+    filtered: listening with a full backlog and never accepting, so new
+        connections get no answer and time out, like a firewalled port
+then scans them with connect_scan.scan() at each concurrency level, and
+once more one port at a time with connect_scan.is_port_up().
+
+Results are printed as JSON lines, one per (stage, concurrency), eg.
+    {"stage": "scan", "concurrency": 100, "probes_per_second": 8123.4,
+     "p50_ms": 0.41, "p99_ms": 61.2, "accuracy": 1.0, "peak_fds": 112, ...}
+
+accuracy is the fraction of ports correctly found open or not open, and
+state_accuracy the fraction whose state (open, closed or filtered) is right.
+
+Requirements:
+    Linux (or anything else with /proc/self/fd) for peak_fds; it's null
+    elsewhere.
+"""
+
+import os
+import sys
+
+import json
+import socket
+import asyncio
+import argparse
+import selectors
+import threading
+from time import perf_counter
+
+from connect_scan import Product, RangeSet, Targets, is_port_up, scan
+
+HOST = '127.0.0.1'
+
+
+class StandIn(object):
+    """Context manager for the open, closed and filtered ports of the
+    stand-in target.
+
+    Attributes:
+        ports (RangeSet): every port of the stand-in
+        expected (dict): port: the state a scan should find it in
+    """
+    def __init__(self, open_ports=50, closed_ports=2000, filtered_ports=20):
+        self.counts = {'open': open_ports, 'closed': closed_ports,
+                       'filtered': filtered_ports}
+        self.ports = RangeSet()
+        self.expected = {}
+        self._sockets = []
+        self._selector = selectors.DefaultSelector()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+
+    def _listen(self, backlog):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((HOST, 0))
+        listener.listen(backlog)
+        self._sockets.append(listener)
+        return listener
+
+    def __enter__(self):
+        for _ in range(self.counts['open']):
+            listener = self._listen(socket.SOMAXCONN)
+            listener.setblocking(False)
+            self._selector.register(listener, selectors.EVENT_READ)
+            self.expected[listener.getsockname()[1]] = 'open'
+
+        for _ in range(self.counts['filtered']):
+            listener = self._listen(0)
+            # One connection fills a backlog of 0; after that the kernel
+            # drops SYNs to the port instead of answering them.
+            filler = socket.create_connection((HOST,
+                                               listener.getsockname()[1]))
+            self._sockets.append(filler)
+            self.expected[listener.getsockname()[1]] = 'filtered'
+
+        # Ports that were free a moment ago, and still are.
+        closed = 0
+        while closed < self.counts['closed']:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind((HOST, 0))
+                port = sock.getsockname()[1]
+            if port not in self.expected:
+                self.expected[port] = 'closed'
+                closed += 1
+
+        self.ports = RangeSet((port, port + 1) for port in self.expected)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._selector.close()
+        for sock in self._sockets:
+            sock.close()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            for key, _ in self._selector.select(timeout=0.1):
+                try:
+                    while True:
+                        connection, _ = key.fileobj.accept()
+                        connection.close()
+                except BlockingIOError:
+                    pass
+
+class FdSampler(object):
+    """Context manager that counts this process's open file descriptors
+    every interval seconds on a thread, and remembers the most it saw."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def count():
+        """Return the number of open file descriptors, or None if that
+        can't be found out here."""
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return None
+
+    def __enter__(self):
+        self.peak = self.count()
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.count() or 0)
+
+
+def _percentile(ordered, fraction):
+    return ordered[int(fraction * (len(ordered) - 1))] if ordered else None
+
+def make_record(stage, concurrency, stand_in, states, latencies, seconds,
+                peak_fds):
+    """Return the JSON record of a stage's results."""
+    latencies = sorted(latencies)
+    expected = stand_in.expected
+    found_open = {port for port, state in states.items() if state == 'open'}
+    expected_open = {port for port, state in expected.items()
+                     if state == 'open'}
+    record = {'stage': stage, 'concurrency': concurrency,
+              'probes': len(latencies), 'seconds': seconds,
+              'probes_per_second': len(latencies) / seconds if seconds
+                                   else None,
+              'p50_ms': _percentile(latencies, 0.5) * 1000,
+              'p99_ms': _percentile(latencies, 0.99) * 1000,
+              'accuracy': sum((port in found_open) == (port in expected_open)
+                              for port in expected) / len(expected),
+              'open_expected': len(expected_open),
+              'open_found': len(found_open & expected_open),
+              'false_open': len(found_open - expected_open),
+              'peak_fds': peak_fds}
+    if stage == 'scan':
+        record['state_accuracy'] = sum(
+            states.get(port) == state
+            for port, state in expected.items()) / len(expected)
+    return record
+
+def bench_scan(stand_in, concurrency, scan_options):
+    """Scan the stand-in with connect_scan.scan() and return its record."""
+    states = {}
+    latencies = []
+
+    def report(seq, host, address, port, state, seconds):
+        states[port] = state
+        latencies.append(seconds)
+
+    # Everything is on one host, so let that host have all of concurrency.
+    work = Product(Targets([HOST]), stand_in.ports).shuffled(0)
+    with FdSampler() as fds:
+        start = perf_counter()
+        asyncio.run(scan(work, report, concurrency=concurrency,
+                         per_host=concurrency, **scan_options))
+        seconds = perf_counter() - start
+
+    return make_record('scan', concurrency, stand_in, states, latencies,
+                       seconds, fds.peak)
+
+def bench_sequential(stand_in):
+    """Scan the stand-in with connect_scan.is_port_up(), a port at a time,
+    and return its record."""
+    states = {}
+    latencies = []
+
+    with FdSampler() as fds:
+        start = perf_counter()
+        for port in stand_in.ports:
+            probe_start = perf_counter()
+            states[port] = 'open' if is_port_up(HOST, port) else 'closed'
+            latencies.append(perf_counter() - probe_start)
+        seconds = perf_counter() - start
+
+    return make_record('sequential', 1, stand_in, states, latencies,
+                       seconds, fds.peak)
+
+
+def main(argv):
+    """Program entry point"""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark connect_scan against a stand-in on localhost')
+    parser.add_argument('--open', type=int, default=50,
+                        help='number of open ports on the stand-in')
+    parser.add_argument('--closed', type=int, default=2000,
+                        help='number of closed ports on the stand-in')
+    parser.add_argument('--filtered', type=int, default=20,
+                        help='number of filtered ports on the stand-in')
+    parser.add_argument('--concurrency',
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        default=[10, 100, 500, 1000],
+                        help='comma separated concurrency levels to scan at')
+    parser.add_argument('--timeout', type=float, default=0.4,
+                        help="scan()'s initial connect timeout")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="scan()'s retries of timed out probes")
+    parser.add_argument('--no-sequential', action='store_true',
+                        help='skip the one port at a time is_port_up() scan')
+    args = parser.parse_args(argv[1:])
+
+    scan_options = {'timeout': args.timeout, 'retries': args.retries}
+    with StandIn(args.open, args.closed, args.filtered) as stand_in:
+        for concurrency in args.concurrency:
+            record = bench_scan(stand_in, concurrency, scan_options)
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+
+        if not args.no_sequential:
+            sys.stdout.write(json.dumps(bench_sequential(stand_in)) + '\n')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -7,26 +7,39 @@ Testing with Chrome 63 and Python 3 on Windows 10
 Requirements:
     watchdog >= 0.8.3
 
-Todo:
-    * Make a better --follow function. Right now it clears the screen then
-    prints n-history entries (default 10) in descending order. I think I'd
-    prefer this command to work more like `tail` though.
-      - update: we're getting closer to this. now the -f switch makes a
-                little more sense, but still clears the screen, and will
-                still print out -n entries over and over if i turned the
-                screen clearing off. so the status of this is very WIP
+Follow mode (-f) works like `tail -f`: it prints the last -n entries once,
+then remembers the newest row it has printed (its watermark) and only ever
+asks the History file for rows past it.
+
+Search mode (-s) keeps a full-text index of urls and titles under the user's
+cache directory and brings it up to date from the History file on every run.
 """
 
 import os
 import sys
 
+import io
+import re
+import csv
+import json
+import heapq
+import functools
+import sqlite3
+import logging
 import argparse
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from queue import Queue, Full
+from time import monotonic, perf_counter, sleep
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-from sqlite_tools import open_temp_sqlite3
+from sqlite_tools import open_sqlite3_snapshot, SNAPSHOT_CACHE
+
+_log = logging.getLogger(__name__)
 
 
 # ██     ██  █████  ████████  ██████ ██   ██ ██████   ██████   ██████
@@ -36,6 +49,73 @@ from sqlite_tools import open_temp_sqlite3
 #  ███ ███  ██   ██    ██     ██████ ██   ██ ██████   ██████   ██████
 
 
+class Debouncer(object):
+    """Coalesce bursts of trigger() calls into single calls of callback.
+
+    callback runs once quiet_period seconds have gone by without a trigger(),
+    or max_latency seconds after the first trigger() of a burst, whichever
+    comes first. It runs on a timer thread, never twice at once.
+    """
+    def __init__(self, callback, quiet_period=0.5, max_latency=2.0):
+        """Set the callback and timings, and zero the counters."""
+        self.callback = callback
+        self.quiet_period = quiet_period
+        self.max_latency = max_latency
+        self.events = 0
+        self.refreshes = 0
+        self.refresh_time = 0.0
+        self._lock = threading.Lock()
+        self._running = threading.Lock()
+        self._timer = None
+        self._generation = 0
+        self._burst_start = None
+
+    def trigger(self):
+        """Note an event, and (re)schedule the callback."""
+        with self._lock:
+            self.events += 1
+            now = monotonic()
+            if self._burst_start is None:
+                self._burst_start = now
+            delay = min(self.quiet_period,
+                        self._burst_start + self.max_latency - now)
+
+            if self._timer is not None:
+                self._timer.cancel()
+            self._generation += 1
+            self._timer = threading.Timer(max(delay, 0), self._fire,
+                                          args=(self._generation,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self, generation):
+        with self._lock:
+            # A timer that was cancelled too late to stop it.
+            if generation != self._generation:
+                return
+            self._timer = None
+            self._burst_start = None
+
+        with self._running:
+            start = perf_counter()
+            self.callback()
+            with self._lock:
+                self.refreshes += 1
+                self.refresh_time += perf_counter() - start
+
+    def cancel(self):
+        """Drop any pending callback."""
+        with self._lock:
+            self._generation += 1
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def log_counters(self):
+        """Log the counters at INFO level (seen with --verbose)."""
+        _log.info('%d events, %d refreshes, %.3f s refreshing',
+                  self.events, self.refreshes, self.refresh_time)
+
 class FileChangedEventHandler(FileSystemEventHandler):
     """Event handler for dispatching on_modified() when a file is changed."""
     # https://stackoverflow.com/questions/11883336/detect-file-creation-with-watchdog
@@ -44,8 +124,16 @@ class FileChangedEventHandler(FileSystemEventHandler):
         self.observer = observer
         self.filename = filename
         self.print_history_args = print_history_args
+        self.history = HistoryData()
+        self.debouncer = Debouncer(self.refresh,
+                                   print_history_args.quiet_period,
+                                   print_history_args.max_latency)
         self.on_modified()
 
+    def refresh(self):
+        """Print whatever is new in the History file."""
+        print_history(self.print_history_args, self.history)
+
     def on_modified(self, event=None):
         """Dispatched by watchdog.events.FileSystemEventHandler when a file
         in the observer path is modified"""
@@ -53,45 +141,66 @@ class FileChangedEventHandler(FileSystemEventHandler):
         if event is None:
             # First run of a --follow comand.  Make sure print_history() is
             # called at least once.
-            print_history(self.print_history_args, follow=True)
+            self.refresh()
         else:
-            if event.src_path == self.filename:
-                print_history(self.print_history_args, follow=True)
+            # Chrome writes History and History-journal in bursts; wait for
+            # the burst to end and refresh once.
+            if event.src_path in (self.filename, self.filename + '-journal'):
+                self.debouncer.trigger()
 
 class HistoryData(object):
-    """Wrapper class for a persistent data object (list of tuples).
-
-    This avoids needing global variables while still keeping a static variable
-    as Python doens't really have static variables for functions.
+    """Remember which rows of the urls table have already been seen.
+
+    Rows are keyed by url id and only their last_visit_time is kept, never the
+    row itself, so telling the new and revisited rows apart from the ones
+    we've seen is a dict lookup per row. Keys older than the watermark can't
+    come back from query_history_since() and are dropped by forget_old(),
+    which keeps memory bounded by the number of rows sharing the newest
+    timestamp.
     """
-    data = []
-    is_first_run = None
-
-    @classmethod
-    def __init__(cls, data):
-        """Initialize HistoryData.data
+    def __init__(self):
+        """Start with nothing seen and no watermark."""
+        self.seen = {}
+        self.watermark = None
 
-        Args:
-            data (list): the result of the first time running a query in
-            follow mode
-        """
-        cls.is_first_run = bool(cls.is_first_run is None)
-        cls.data = data
-
-    @classmethod
-    def get_difference(cls, newdata):
-        """Return a list of tuples containing the intersection of our stored
-        data and the data passed.
+    def get_difference(self, newdata):
+        """Return a list of the rows in newdata that are new or have been
+        visited since we last saw them, and remember them.
 
         Args:
-            data (list): the result of the most recent database query
+            newdata (iterable): rows of HISTORY_QUERY, in any order
         """
-        return [row for row in newdata if row not in cls.data]
-
-    @classmethod
-    def append_data(cls, newdata):
-        """Append newdata (list) to data (list)."""
-        cls.data.append(newdata)
+        seen = self.seen
+        max_id, max_time = self.watermark or (0, 0)
+        difference = []
+
+        for row in newdata:
+            url_id, last_visit_time = row[3], row[2]
+            if seen.get(url_id) == last_visit_time:
+                continue
+
+            seen[url_id] = last_visit_time
+            difference.append(row)
+            max_id = max(max_id, url_id)
+            max_time = max(max_time, last_visit_time)
+
+        self.watermark = (max_id, max_time)
+        return difference
+
+    def advance(self, connection):
+        """Move the watermark up to the newest url id and visit time in the
+        History database open on connection."""
+        max_id, max_time = connection.execute(NEWEST_QUERY).fetchone()
+        self.watermark = (max(self.watermark[0], max_id or 0),
+                          max(self.watermark[1], max_time or 0))
+
+    def forget_old(self):
+        """Forget the keys of rows visited before the watermark."""
+        if self.watermark is not None:
+            max_time = self.watermark[1]
+            self.seen = {url_id: last_visit_time
+                         for url_id, last_visit_time in self.seen.items()
+                         if last_visit_time >= max_time}
 
 
     # ██    ██ ███████ ███████ ██████  ██████   █████  ████████  █████
@@ -101,6 +210,24 @@ class HistoryData(object):
     #  ██████  ███████ ███████ ██   ██ ██████  ██   ██    ██    ██   ██
 
 
+HISTORY_QUERY = 'select url, title, last_visit_time, id from urls'
+
+# The host part of the url column, eg. 'www.google.com'.
+HOST_SQL = ('substr(substr(url, instr(url, \'://\') + 3), 1,'
+            ' instr(substr(url, instr(url, \'://\') + 3) || \'/\', \'/\')'
+            ' - 1)')
+
+# Both served by an index, unlike max(last_visit_time) from urls.
+NEWEST_QUERY = ('select (select max(id) from urls),'
+                ' (select max(visit_time) from visits)')
+
+# Chrome stores times as microseconds since 1601-01-01 00:00:00 UTC.
+CHROME_EPOCH = datetime(1601, 1, 1)
+
+FORMATS = ['plain', 'markdown', 'jsonl', 'csv']
+CSV_HEADER = ['time', 'title', 'url', 'last_visit_time', 'id']
+
+
 def get_chrome_userdata_path():
     """Return this platform's default path to 'User Data' as a string that
     this platform understands. (eg. On Windows,
@@ -117,85 +244,372 @@ def get_chrome_userdata_path():
 
     return os.path.join(os.getenv(environmant_name), *chrome_path_elements)
 
-def print_data_from_tuple(args, data):
-    """An accessory function to print_history()
+def get_history_filename(profile):
+    """Return the filename of profile's History database."""
+    return os.path.join(get_chrome_userdata_path(), profile, 'History')
+
+def format_chrome_time(chrome_time):
+    """Return a Chrome timestamp as a string like '2017-09-09 13:20:07' (UTC),
+    the same as sqlite's datetime() would."""
+    return (CHROME_EPOCH + timedelta(microseconds=chrome_time)).strftime(
+        '%Y-%m-%d %H:%M:%S')
 
-    Print data inside tuple according to args. Data are a list of tuples like:
-    ('2017-9-9 13:20:07',
-     'hello world - Google Search'
-     'https://www.google.com/search?q=hello+world')
+def parse_chrome_time(value):
+    """Argparse type for --since and --until.
+
+    Return an ISO 8601 date or time (local time unless it says otherwise) as
+    a Chrome timestamp, so it can be compared with last_visit_time in SQL.
     """
-    for index, row in enumerate(data):
-        if args.all is not True and len(data) - args.count > index:
-            continue
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected an ISO 8601 date or time, got \'' + value + '\'')
+
+    # Naive times are local; astimezone() assumes as much.
+    since_epoch = (when.astimezone(timezone.utc) -
+                   CHROME_EPOCH.replace(tzinfo=timezone.utc))
+    return since_epoch // timedelta(microseconds=1)
+
+def parse_regex(value):
+    """Argparse type for --url-regex: check that value compiles."""
+    try:
+        re.compile(value)
+    except re.error as error:
+        raise argparse.ArgumentTypeError(
+            'bad regular expression \'' + value + '\': ' + str(error))
+    return value
+
+@functools.lru_cache(maxsize=16)
+def _compile(pattern):
+    return re.compile(pattern)
+
+def _regexp(pattern, value):
+    """Implementation of sqlite's 'value regexp pattern'."""
+    return value is not None and _compile(pattern).search(value) is not None
+
+def add_history_functions(connection):
+    """Register the sql functions filter_conditions() relies on (regexp)
+    on connection. Call once per connection."""
+    connection.create_function('regexp', 2, _regexp, deterministic=True)
+
+def _like_escape(value):
+    return (value.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_'))
+
+def filter_conditions(args, visits=True):
+    """Return (conditions, parameters) for the filter options in args: a list
+    of sql conditions on the columns of HISTORY_QUERY to be joined with
+    'and', and the values for their placeholders.
 
-        if args.time is True:
-            print(row[2], end=': ')
+    Args:
+        args (argparse.Namespace): options passed to program.
+        visits (bool): the conditions are for the urls table of a History
+            file. urls has no index on last_visit_time, so --since is also
+            given as a lookup through visits_time_index that sqlite can use
+            to avoid scanning every url.
+    """
+    conditions = []
+    parameters = []
+    if args.since is not None:
+        if visits:
+            conditions.append(
+                'id in (select url from visits where visit_time >= ?)')
+            parameters.append(args.since)
+        conditions.append('last_visit_time >= ?')
+        parameters.append(args.since)
+    if args.until is not None:
+        conditions.append('last_visit_time < ?')
+        parameters.append(args.until)
+    if args.domain is not None:
+        conditions.append('({host} like ? escape \'\\\' or '
+                          '{host} like ? escape \'\\\')'.format(host=HOST_SQL))
+        parameters.append(_like_escape(args.domain))
+        parameters.append('%.' + _like_escape(args.domain))
+    if args.title_contains is not None:
+        conditions.append('title like ? escape \'\\\'')
+        parameters.append('%' + _like_escape(args.title_contains) + '%')
+    if args.url_regex is not None:
+        conditions.append('url regexp ?')
+        parameters.append(args.url_regex)
+    return conditions, parameters
+
+def where_clause(conditions):
+    """Return conditions joined into a ' where ...' clause, or ''."""
+    return ' where ' + ' and '.join(conditions) if conditions else ''
+
+def format_row(args, row):
+    """An accessory function to print_data_from_tuple()
+
+    Return one row of HISTORY_QUERY formatted according to args as a string,
+    including its trailing newline(s).
+    """
+    line = format_chrome_time(row[2]) + ': ' if args.time is True else ''
 
-        if len(row[1]) < 1:
-            if args.markdown is True:
-                print('[No Title]', end='')
-            else:
-                print('-', end=' ')
-                if args.url is not True:
-                    # Print the url anyways since title is missing
-                    print(row[0], end=' ')
+    if len(row[1]) < 1:
+        if args.markdown is True:
+            line += '[No Title]'
         else:
-            if args.markdown is True:
-                print('[' + row[1] + ']', end='')
-            else:
-                print(row[1], end=' ')
+            line += '- '
+            if args.url is not True:
+                # Print the url anyways since title is missing
+                line += row[0] + ' '
+    else:
+        if args.markdown is True:
+            line += '[' + row[1] + ']'
+        else:
+            line += row[1] + ' '
 
-        if args.url is True or args.markdown is True:
-            print('(' + row[0] + ')')
+    if args.url is True or args.markdown is True:
+        line += '(' + row[0] + ')'
+
+    if args.markdown is True:
+        line += '\n' # extra line to separate links on the page
+
+    return line + '\n'
+
+def format_jsonl(args, row):
+    """An accessory function to print_data_from_tuple()
+
+    Return one row of HISTORY_QUERY as a line of JSON.
+    """
+    return json.dumps({'time': format_chrome_time(row[2]),
+                       'title': row[1],
+                       'url': row[0],
+                       'last_visit_time': row[2],
+                       'id': row[3]}, ensure_ascii=False) + '\n'
+
+def format_csv(args, rows):
+    """An accessory function to print_data_from_tuple()
+
+    Return rows of HISTORY_QUERY as CSV.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerows((format_chrome_time(row[2]), row[1], row[0], row[2],
+                      row[3]) for row in rows)
+    return buffer.getvalue()
+
+def print_data_from_tuple(args, data, out=None, header=True):
+    """An accessory function to print_history()
+
+    Print every row in data in args.format to out (args.output or stdout by
+    default). Data are an iterable of tuples like those from HISTORY_QUERY:
+    ('https://www.google.com/search?q=hello+world',
+     'hello world - Google Search',
+     13150531207000000,
+     1234)
+    Rows are formatted in batches and written with one call per batch.
+    CSV output starts with CSV_HEADER unless header is False, as when
+    following adds rows to output that already has one.
+    """
+    out = out or args.output or sys.stdout
+    if args.format == 'csv' and header:
+        csv.writer(out, lineterminator='\n').writerow(CSV_HEADER)
+    rows = iter(data)
+    for batch in iter(lambda: list(islice(rows, 1000)), []):
+        if args.format == 'csv':
+            out.write(format_csv(args, batch))
+        elif args.format == 'jsonl':
+            out.write(''.join(format_jsonl(args, row) for row in batch))
         else:
-            print()
+            out.write(''.join(format_row(args, row) for row in batch))
+    out.flush()
+
+def explain_query(connection, query, parameters=(), out=None):
+    """Print query, its parameters and sqlite's plan for it (to stderr by
+    default)."""
+    out = out or sys.stderr
+    out.write(query + '\n' + repr(tuple(parameters)) + '\n')
+
+    depths = {0: 0}
+    for node, parent, _, detail in connection.execute(
+            'explain query plan ' + query, parameters):
+        depths[node] = depths.get(parent, 0) + 1
+        out.write('  ' * depths[node] + detail + '\n')
+    out.flush()
+
+def query_history(args, connection, query, parameters=()):
+    """An accessory function to print_query()
+
+    Run query (which must select the columns of HISTORY_QUERY and have no
+    order by) and return a cursor over the rows args asks for: all of them
+    oldest first if args.all, otherwise the last args.count newest first.
+    With --explain, the query plan is printed first.
+    """
+    if args.all is True:
+        query += ' order by last_visit_time'
+    else:
+        query += ' order by last_visit_time desc limit ?'
+        parameters = tuple(parameters) + (args.count,)
 
-        if args.markdown is True:
-            print() # extra line to separate links on the page
+    if args.explain is True:
+        explain_query(connection, query, parameters)
+
+    return connection.execute(query, parameters)
 
+def print_query(args, connection, query, parameters=()):
+    """An accessory function to print_history()
+
+    Print the rows of query_history() oldest first. With --all, rows are
+    streamed from the cursor, so memory use doesn't depend on the size of the
+    history. Otherwise the last -n rows are fetched to be printed in reverse.
+    """
+    cursor = query_history(args, connection, query, parameters)
+    if args.all is True:
+        print_data_from_tuple(args, cursor)
+    else:
+        print_data_from_tuple(args, reversed(cursor.fetchall()))
 
-    # ██████  ██████  ██ ███    ██ ████████
-    # ██   ██ ██   ██ ██ ████   ██    ██
-    # ██████  ██████  ██ ██ ██  ██    ██
-    # ██      ██   ██ ██ ██  ██ ██    ██
-    # ██      ██   ██ ██ ██   ████    ██
 
+def query_history_since(connection, watermark, conditions=(),
+                        parameters=()):
+    """An accessory function to print_history()
+
+    Return a cursor over the rows of urls that were added or visited at or
+    after watermark, oldest first. Both halves of the where clause are served
+    by an index (the urls rowid and visits_time_index), so the cost depends
+    on the number of new visits rather than on the size of the history.
 
-def print_history(args, follow=False):
+    Args:
+        connection (sqlite3.Connection): an open History database
+        watermark (tuple): (id, last_visit_time) of the newest row seen
+        conditions (list): more conditions from filter_conditions()
+        parameters (list): the values for conditions' placeholders
+    """
+    max_id, max_time = watermark
+    return connection.execute(
+        HISTORY_QUERY + where_clause(
+            ['(id > ? or id in '
+             '(select url from visits where visit_time >= ?))'] +
+            list(conditions)) +
+        ' order by last_visit_time, id',
+        (max_id, max_time) + tuple(parameters))
+
+def print_history(args, history=None):
     """Read some rows of a chrome history database.
 
     Args:
         args (argparse.Namespace): options passed to program.
-        follow (bool): were we run from follow mode
+        history (HistoryData): what a previous call has already printed. If
+            it has a watermark, only rows newer than it are printed (follow
+            mode).
     """
-    history_filename = os.path.join(
-        get_chrome_userdata_path(), args.profile, 'History')
+    history_filename = get_history_filename(args.profile)
+
+    with open_sqlite3_snapshot(history_filename,
+                               cache=SNAPSHOT_CACHE) as connection:
+        add_history_functions(connection)
+        conditions, parameters = filter_conditions(args)
+
+        if history is None or history.watermark is None:
+            print_query(args, connection,
+                        HISTORY_QUERY + where_clause(conditions), parameters)
+            if history is not None:
+                # Start following from the newest row in the file, and
+                # remember the rows on that row's timestamp.
+                history.watermark = (0, 0)
+                history.advance(connection)
+                history.get_difference(query_history_since(
+                    connection, history.watermark, conditions, parameters))
+        else:
+            print_data_from_tuple(args, history.get_difference(
+                query_history_since(connection, history.watermark,
+                                    conditions, parameters)),
+                header=False)
+            # Rows the filters left out mustn't hold the watermark back.
+            history.advance(connection)
+
+        # Once --search has built an index, keep it up to date for free
+        # while we have the History file open anyway.
+        index_filename = get_search_index_filename(args.profile)
+        if os.path.isfile(index_filename):
+            update_search_index(connection, index_filename)
+
+    if history is not None:
+        history.forget_old()
+
+def _put_or_stop(rows, item, stop):
+    """Put item on the queue rows, giving up if stop is set meanwhile."""
+    while not stop.is_set():
+        try:
+            rows.put(item, timeout=0.1)
+            return
+        except Full:
+            continue
 
-    query_string = (
-        'select url, title,'
-        'datetime(last_visit_time/1000000-11644473600, "unixepoch")'
-        'from urls order by last_visit_time'
-    )
+def read_profile_history(args, profile, rows, stop):
+    """An accessory function to print_profiles_history()
 
-    with open_temp_sqlite3(history_filename, query=query_string) as cursor:
-        # data = cursor.fetchall()
-        data = HistoryData(cursor.fetchall())
+    Snapshot profile's History file and put the rows of query_history() onto
+    the queue rows in batches, followed by None. Errors are put on the queue
+    in place of a batch for the reader to raise. Runs in a worker thread.
+    """
+    try:
+        with open_sqlite3_snapshot(get_history_filename(profile),
+                                   cache=SNAPSHOT_CACHE) as connection:
+            add_history_functions(connection)
+            conditions, parameters = filter_conditions(args)
+            cursor = query_history(args, connection,
+                                   HISTORY_QUERY + where_clause(conditions),
+                                   parameters)
+            for batch in iter(lambda: cursor.fetchmany(1000), []):
+                _put_or_stop(rows, batch, stop)
+                if stop.is_set():
+                    break
+    except (OSError, sqlite3.Error) as error:
+        _put_or_stop(rows, error, stop)
+    finally:
+        _put_or_stop(rows, None, stop)
+
+def _iter_queue(rows):
+    """Yield the rows put on the queue rows by read_profile_history()."""
+    while True:
+        batch = rows.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield from batch
+
+def print_profiles_history(args, profiles):
+    """Read some rows of several chrome history databases at once and print
+    them as one history, ordered by visit time.
+
+    Every profile is snapshotted and queried on its own worker thread, and
+    the sorted streams they produce are merged with a heap as they arrive,
+    so printing starts as soon as each profile has sent its first batch.
 
-    if follow and not data.is_first_run:
-        args.all = True
-        data = data.get_difference(data)
+    Args:
+        args (argparse.Namespace): options passed to program.
+        profiles (list): names of the profiles to read.
+    """
+    stop = threading.Event()
+    queues = [Queue(maxsize=4) for _ in profiles]
 
-    print_data_from_tuple(args, data.data)
+    # One thread per profile: the merge needs the head of every stream
+    # before it can print anything.
+    with ThreadPoolExecutor(max_workers=len(profiles)) as executor:
+        for profile, rows in zip(profiles, queues):
+            executor.submit(read_profile_history, args, profile, rows, stop)
 
-def list_chrome_profiles():
-    """List all sub-directories of the chrome 'User Data' path that contain a
-    valid History sqlite3 database and print the profile names to stdout.
-
-    Return: 0 if at least one valid profile was found. 1 otherwise.
+        try:
+            merged = heapq.merge(*(_iter_queue(rows) for rows in queues),
+                                 key=lambda row: row[2],
+                                 reverse=args.all is not True)
+            if args.all is True:
+                print_data_from_tuple(args, merged)
+            else:
+                data = list(islice(merged, args.count))
+                print_data_from_tuple(args, reversed(data))
+        finally:
+            stop.set()
+
+def find_chrome_profiles():
+    """Yield the names of all sub-directories of the chrome 'User Data' path
+    that contain a valid History sqlite3 database.
     """
     userdata = get_chrome_userdata_path()
-    found_valid_profile = False
 
     # os.listdir() is significantly faster than glob.glob() and has enough
     # functionality for what we need.
@@ -205,13 +619,236 @@ def list_chrome_profiles():
             # pylint complains about the spacing above.  According to the
             # Google Python Style Guide, this is the correct way and pylint
             # is wrong.
-            print(element)
-            if not found_valid_profile:
-                found_valid_profile = True
+            yield element
+
+def list_chrome_profiles():
+    """List all sub-directories of the chrome 'User Data' path that contain a
+    valid History sqlite3 database and print the profile names to stdout.
+
+    Return: 0 if at least one valid profile was found. 1 otherwise.
+    """
+    found_valid_profile = False
+
+    for element in find_chrome_profiles():
+        print(element)
+        if not found_valid_profile:
+            found_valid_profile = True
 
     return 0 if found_valid_profile else 1
 
 
+    # ███████ ███████  █████  ██████   ██████ ██   ██
+    # ██      ██      ██   ██ ██   ██ ██      ██   ██
+    # ███████ █████   ███████ ██████  ██      ███████
+    #      ██ ██      ██   ██ ██   ██ ██      ██   ██
+    # ███████ ███████ ██   ██ ██   ██  ██████ ██   ██
+
+
+def get_cache_path(create=False):
+    """Return this platform's cache directory for inspect_history as a string,
+    creating it if create is set. (eg. On Linux, '~/.cache/inspect_history')
+    """
+    if sys.platform.startswith('win32') or sys.platform.startswith('cygwin'):
+        cache_root = os.getenv('LOCALAPPDATA')
+    else:
+        cache_root = (os.getenv('XDG_CACHE_HOME') or
+                      os.path.join(os.getenv('HOME'), '.cache'))
+
+    cache_path = os.path.join(cache_root, 'inspect_history')
+    if create:
+        os.makedirs(cache_path, exist_ok=True)
+    return cache_path
+
+def get_search_index_filename(profile, create=False):
+    """Return the filename of the full-text search index for profile,
+    creating its directory if create is set."""
+    return os.path.join(get_cache_path(create), profile + '.search.sqlite3')
+
+def update_search_index(connection, index_filename):
+    """Bring the full-text search index at index_filename up to date with
+    the History database open on connection.
+
+    The index is an FTS5 table of urls and titles keyed by urls.id, plus the
+    watermark of the newest row indexed, so only rows added or visited since
+    the last update are read from History.
+
+    Rows deleted from History since (cleared by the user or expired by
+    Chrome) are deleted from the index too. Once the new rows are in, the
+    index has more rows than urls only if some were deleted, so the ids of
+    urls are only read when the counts differ.
+
+    Args:
+        connection (sqlite3.Connection): an open History database
+        index_filename (str): the sidecar index (created if missing)
+    """
+    with sqlite3.connect(index_filename) as index:
+        index.execute(
+            'create virtual table if not exists history '
+            'using fts5(url, title, last_visit_time unindexed)')
+        index.execute(
+            'create table if not exists watermark '
+            '(id integer not null, last_visit_time integer not null)')
+
+        watermark = index.execute(
+            'select id, last_visit_time from watermark').fetchone() or (0, 0)
+        max_id, max_time = watermark
+
+        # Rows sitting exactly on the watermark come back every time; the
+        # replace makes indexing them again harmless.
+        cursor = query_history_since(connection, watermark)
+        for rows in iter(lambda: cursor.fetchmany(1000), []):
+            index.executemany(
+                'insert or replace into history '
+                '(rowid, url, title, last_visit_time) values (?, ?, ?, ?)',
+                ((row[3], row[0], row[1], row[2]) for row in rows))
+            max_id = max(max_id, max(row[3] for row in rows))
+            max_time = max(max_time, rows[-1][2])
+
+        if (index.execute('select count(*) from history').fetchone() !=
+                connection.execute('select count(*) from urls').fetchone()):
+            index.execute('create temp table live (id integer primary key)')
+            cursor = connection.execute('select id from urls')
+            for rows in iter(lambda: cursor.fetchmany(10000), []):
+                index.executemany('insert into live values (?)', rows)
+            index.execute('delete from history '
+                          'where rowid not in (select id from live)')
+            index.execute('drop table live')
+
+        if (max_id, max_time) != watermark:
+            index.execute('delete from watermark')
+            index.execute('insert into watermark values (?, ?)',
+                          (max_id, max_time))
+
+def search_history(args):
+    """Print the rows of the History file whose url or title match the
+    full-text query args.search, oldest first.
+
+    Args:
+        args (argparse.Namespace): options passed to program.
+
+    Return: 0 if the query could be run. 1 otherwise.
+    """
+    history_filename = get_history_filename(args.profile)
+    index_filename = get_search_index_filename(args.profile, create=True)
+
+    with open_sqlite3_snapshot(history_filename,
+                               cache=SNAPSHOT_CACHE) as connection:
+        update_search_index(connection, index_filename)
+
+    with sqlite3.connect(index_filename) as index:
+        add_history_functions(index)
+        conditions, parameters = filter_conditions(args, visits=False)
+        try:
+            print_query(args, index,
+                        'select url, title, last_visit_time, rowid '
+                        'from history' +
+                        where_clause(['history match ?'] + conditions),
+                        [args.search] + parameters)
+        except sqlite3.OperationalError as error:
+            print('Bad search query \'' + args.search + '\': ' + str(error),
+                  file=sys.stderr)
+            return 1
+
+    return 0
+
+
+    # ███████ ████████  █████  ████████ ███████
+    # ██         ██    ██   ██    ██    ██
+    # ███████    ██    ███████    ██    ███████
+    #      ██    ██    ██   ██    ██         ██
+    # ███████    ██    ██   ██    ██    ███████
+
+
+# Every aggregate is computed by sqlite; Python only ever sees the results.
+STATS_QUERIES = {
+    'domains': (
+        'select ' + HOST_SQL + ' as domain, sum(visit_count) as visits '
+        'from urls where instr(url, \'://\') > 0 '
+        'group by domain order by visits desc limit :count'),
+    'urls': (
+        'select url, visit_count from urls '
+        'order by visit_count desc limit :count'),
+    'hours': (
+        'select cast(strftime(\'%H\', visit_time/1000000-11644473600,'
+        ' \'unixepoch\', \'localtime\') as integer) as hour, count(*) '
+        'from visits group by hour order by hour'),
+    'weekdays': (
+        'select cast(strftime(\'%w\', visit_time/1000000-11644473600,'
+        ' \'unixepoch\', \'localtime\') as integer) as weekday, count(*) '
+        'from visits group by weekday order by weekday'),
+}
+
+WEEKDAYS = ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat']
+
+def get_history_stats(args):
+    """Return a dict of the aggregates in STATS_QUERIES for args.profile,
+    each a list of [label, count] pairs.
+
+    Results are cached under get_cache_path(), keyed on the History file's
+    size and mtime, so asking again before Chrome writes to it is free.
+    """
+    history_filename = get_history_filename(args.profile)
+    stats_filename = os.path.join(get_cache_path(create=True),
+                                  args.profile + '.stats.json')
+
+    stat = os.stat(history_filename)
+    key = [stat.st_size, stat.st_mtime_ns, args.count]
+
+    try:
+        with open(stats_filename) as stats_file:
+            cached = json.load(stats_file)
+        if cached['key'] == key:
+            return cached['stats']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with open_sqlite3_snapshot(history_filename,
+                               cache=SNAPSHOT_CACHE) as connection:
+        stats = {name: connection.execute(query, {'count': args.count})
+                 .fetchall() for name, query in STATS_QUERIES.items()}
+
+    with open(stats_filename, 'w') as stats_file:
+        json.dump({'key': key, 'stats': stats}, stats_file)
+
+    return stats
+
+def print_histogram(title, rows, out, width=40):
+    """An accessory function to print_stats()
+
+    Print rows of (label, count) under title with a bar for each count.
+    """
+    out.write(title + '\n')
+    largest = max((count for _, count in rows), default=0) or 1
+    for label, count in rows:
+        out.write('  {:>5} {:>9} {}\n'.format(
+            label, count, '#' * round(width * count / largest)))
+    out.write('\n')
+
+def print_stats(args):
+    """Print top domains, top urls and visits by hour and weekday for
+    args.profile.
+
+    Return: 0
+    """
+    stats = get_history_stats(args)
+    out = sys.stdout
+
+    for title, name in (('Top domains', 'domains'), ('Top urls', 'urls')):
+        out.write(title + '\n')
+        for label, count in stats[name]:
+            out.write('  {:>9} {}\n'.format(count, label))
+        out.write('\n')
+
+    print_histogram('Visits by hour', [('{:02}'.format(hour), count)
+                                       for hour, count in stats['hours']],
+                    out)
+    print_histogram('Visits by weekday', [(WEEKDAYS[day], count)
+                                          for day, count in stats['weekdays']],
+                    out)
+    out.flush()
+    return 0
+
+
     # ███    ███  █████  ██ ███    ██
     # ████  ████ ██   ██ ██ ████   ██
     # ██ ████ ██ ███████ ██ ██ ██  ██
@@ -227,9 +864,15 @@ def main(argv):
     parser.add_argument('-l', '--list-profiles',
                         action='store_true', default='False',
                         help='List all chrome profiles for the current user')
-    parser.add_argument('-p', '--profile',
-                        default='Default',
-                        help='the Chrome profile name to inspect')
+    profile_group = parser.add_mutually_exclusive_group()
+    profile_group.add_argument('-p', '--profile',
+                               default='Default',
+                               help='the Chrome profile name to inspect, or '
+                                    '\'all\' to merge every profile')
+    profile_group.add_argument('--profiles',
+                               type=lambda value: value.split(','),
+                               help='comma separated list of profiles to '
+                                    'inspect and merge')
     parser.add_argument('-t', '--time',
                         action='store_true', default=False,
                         help='Print the time of the history entry')
@@ -239,9 +882,43 @@ def main(argv):
     parser.add_argument('-m', '--markdown',
                         action='store_true', default=False,
                         help='Output in Markdown-friendly format')
+    parser.add_argument('--format',
+                        choices=FORMATS, default='plain',
+                        help='output format (-m is short for --format '
+                             'markdown)')
+    parser.add_argument('-o', '--output',
+                        type=argparse.FileType('w', encoding='utf-8'),
+                        help='write entries to this file instead of stdout')
+    parser.add_argument('--since',
+                        type=parse_chrome_time, metavar='TIME',
+                        help='only entries last visited at or after TIME '
+                             '(ISO 8601, local time by default)')
+    parser.add_argument('--until',
+                        type=parse_chrome_time, metavar='TIME',
+                        help='only entries last visited before TIME')
+    parser.add_argument('--domain',
+                        help='only entries on this domain or its subdomains')
+    parser.add_argument('--title-contains',
+                        metavar='TEXT',
+                        help='only entries whose title contains TEXT '
+                             '(ignoring ASCII case)')
+    parser.add_argument('--url-regex',
+                        type=parse_regex, metavar='REGEX',
+                        help='only entries whose url matches REGEX')
+    parser.add_argument('--explain',
+                        action='store_true', default=False,
+                        help='print the SQL query plan to stderr')
     parser.add_argument('-f', '--follow',
                         action='store_true', default='False',
                         help='follow profile\'s History file for changes')
+    parser.add_argument('--quiet-period',
+                        type=float, default=0.5, metavar='SECONDS',
+                        help='with --follow, wait for this long without '
+                             'changes before refreshing')
+    parser.add_argument('--max-latency',
+                        type=float, default=2.0, metavar='SECONDS',
+                        help='with --follow, refresh at most this long after '
+                             'a change even if changes keep coming')
     count_group = parser.add_mutually_exclusive_group()
     count_group.add_argument('-n', '--count',
                              type=int, default=10,
@@ -249,19 +926,56 @@ def main(argv):
     count_group.add_argument('-a', '--all',
                              action='store_true', default=False,
                              help='print all entries in History file')
+    parser.add_argument('-s', '--search',
+                        metavar='QUERY',
+                        help='Full-text search urls and titles (FTS5 syntax)')
+    parser.add_argument('--stats',
+                        action='store_true', default=False,
+                        help='Print top domains and urls (-n of each) and '
+                             'visits by hour and weekday')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true', default=False,
+                        help='Log how the History file was opened to stderr')
     args = parser.parse_args(argv[1:])
 
+    if args.verbose is True:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.markdown is True:
+        args.format = 'markdown'
+    args.markdown = args.format == 'markdown'
+
     # --list-profiles will preempt other functionality
     if args.list_profiles is True:
         return list_chrome_profiles()
 
+    if args.profiles is None and args.profile == 'all':
+        args.profiles = sorted(find_chrome_profiles())
+
+    if args.profiles is not None:
+        if not args.profiles:
+            print('No Chrome profiles found', file=sys.stderr)
+            return 1
+        if (args.search is not None or args.follow is True or
+            args.stats is True):
+            parser.error('--search, --stats and --follow need a single '
+                         '--profile')
+        print_profiles_history(args, args.profiles)
+        return 0
+
+    if args.search is not None:
+        return search_history(args)
+
+    if args.stats is True:
+        return print_stats(args)
+
     # Read table from database.
     if args.follow is True:
         observer = Observer()
-        history_filename = os.path.join(get_chrome_userdata_path(),
-                                        args.profile, 'History')
+        history_filename = get_history_filename(args.profile)
+        handler = FileChangedEventHandler(observer, history_filename, args)
         observer.schedule(
-            FileChangedEventHandler(observer, history_filename, args),
+            handler,
             os.path.join(get_chrome_userdata_path(), args.profile)
         )
 
@@ -273,6 +987,8 @@ def main(argv):
         except KeyboardInterrupt:
             observer.stop()
         observer.join()
+        handler.debouncer.cancel()
+        handler.debouncer.log_counters()
 
     else:
         print_history(args)
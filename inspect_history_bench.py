@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark inspect_history.py and sqlite_tools.py on synthetic History files.
+
+Generates Chrome-schema History databases (the urls and visits tables and
+their indexes) of the requested sizes, then times each stage on its own:
+snapshotting, querying, loading every row (with its memory use),
+HistoryData diffing, formatting/printing, and the cost of a --follow
+refresh after some new visits.
+
+Results are printed as JSON lines, one per (rows, stage), eg.
+    {"rows": 10000, "stage": "query_all", "seconds": 0.0123, ...}
+
+Generated databases are kept in --dir and reused by later runs.
+
+Requirements:
+    the same as inspect_history.py
+"""
+
+import os
+import sys
+
+import json
+import random
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import inspect_history
+from inspect_history import (HISTORY_QUERY, HistoryData,
+                             print_data_from_tuple, query_history,
+                             query_history_since)
+from sqlite_tools import open_temp_sqlite3, open_sqlite3_snapshot
+
+# The parts of Chrome's History schema that inspect_history reads.
+HISTORY_SCHEMA = '''
+create table urls(id integer primary key autoincrement,
+                  url longvarchar, title longvarchar,
+                  visit_count integer default 0 not null,
+                  typed_count integer default 0 not null,
+                  last_visit_time integer not null,
+                  hidden integer default 0 not null);
+create index urls_url_index on urls (url);
+create table visits(id integer primary key, url integer not null,
+                    visit_time integer not null, from_visit integer,
+                    transition integer default 0 not null,
+                    segment_id integer,
+                    visit_duration integer default 0 not null);
+create index visits_url_index on visits (url);
+create index visits_time_index on visits (visit_time);
+'''
+
+DOMAINS = ['www.google.com', 'github.com', 'docs.python.org',
+           'news.ycombinator.com', 'en.wikipedia.org', 'stackoverflow.com',
+           'www.youtube.com', 'mail.google.com']
+
+# 2022-06-18, in Chrome's microseconds since 1601.
+START_TIME = 13300000000000000
+
+
+def _synthetic_urls(rows, start_id=1, start_time=START_TIME, seed=0):
+    """Yield rows for the urls table, one visit apart on average 30 s."""
+    rng = random.Random(seed)
+    visit_time = start_time
+    for url_id in range(start_id, start_id + rows):
+        visit_time += rng.randint(1, 60 * 1000000)
+        domain = rng.choice(DOMAINS)
+        title = '' if url_id % 7 == 0 else \
+            'Page {} on {} - synthetic history'.format(url_id, domain)
+        yield (url_id, 'https://{}/page/{}?q={}'.format(
+            domain, url_id, rng.getrandbits(32)), title,
+               rng.randint(1, 50), visit_time)
+
+def add_visits(filename, rows, start_id, start_time, seed=0):
+    """Append rows new urls, each with one visit, to the History file."""
+    with sqlite3.connect(filename) as connection:
+        for row in _synthetic_urls(rows, start_id, start_time, seed):
+            connection.execute(
+                'insert into urls (id, url, title, visit_count, '
+                'last_visit_time) values (?, ?, ?, ?, ?)', row)
+            connection.execute(
+                'insert into visits (url, visit_time) values (?, ?)',
+                (row[0], row[4]))
+    connection.close()
+
+def make_history(filename, rows):
+    """Create a synthetic History file with rows urls and one visit each."""
+    with sqlite3.connect(filename) as connection:
+        connection.executescript(HISTORY_SCHEMA)
+        connection.executemany(
+            'insert into urls (id, url, title, visit_count, last_visit_time) '
+            'values (?, ?, ?, ?, ?)', _synthetic_urls(rows))
+        connection.execute(
+            'insert into visits (url, visit_time) '
+            'select id, last_visit_time from urls order by id')
+    connection.close()
+
+def get_history(directory, rows):
+    """Return the filename of a synthetic History file with rows urls,
+    generating it if there isn't one in directory already."""
+    filename = os.path.join(directory, 'History-{}'.format(rows))
+    if not os.path.isfile(filename):
+        make_history(filename + '.tmp', rows)
+        os.replace(filename + '.tmp', filename)
+    return filename
+
+def make_args(**kwargs):
+    """Return the argparse.Namespace that inspect_history's printers expect,
+    as if it was run with no options, updated with kwargs."""
+    args = argparse.Namespace(all=False, count=10, time=True, url=True,
+                              markdown=False, format='plain', output=None,
+                              since=None, until=None, domain=None,
+                              title_contains=None, url_regex=None,
+                              explain=False)
+    vars(args).update(kwargs)
+    return args
+
+
+class Bench(object):
+    """Time stages and print a JSON line for each."""
+    def __init__(self, rows, repeat, out):
+        self.rows = rows
+        self.repeat = repeat
+        self.out = out
+
+    def time(self, stage, function, setup=None):
+        """Run function repeat times (after setup, untimed) and report the
+        fastest run. function may return the number of rows it handled."""
+        timings = []
+        handled = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = perf_counter()
+            handled = function()
+            timings.append(perf_counter() - start)
+
+        best = min(timings)
+        record = {'rows': self.rows, 'stage': stage, 'seconds': best,
+                  'median_seconds': sorted(timings)[len(timings) // 2],
+                  'repeat': self.repeat}
+        if isinstance(handled, int):
+            record['handled'] = handled
+            record['rows_per_second'] = handled / best if best else None
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def memory(self, stage, function):
+        """Run function once and report the peak memory it allocated, and
+        how much of it is still held by what it returned."""
+        tracemalloc.start()
+        try:
+            start = perf_counter()
+            result = function()
+            seconds = perf_counter() - start
+            held, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        record = {'rows': self.rows, 'stage': stage, 'seconds': seconds,
+                  'peak_bytes': peak, 'held_bytes': held}
+        if result is not None:
+            record['handled'] = len(result)
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+
+def _count(rows):
+    return sum(1 for _ in rows)
+
+def bench_history(filename, rows, repeat, new_visits, out):
+    """Time every stage against the History file filename."""
+    bench = Bench(rows, repeat, out)
+    devnull = open(os.devnull, 'w')
+
+    def snapshot(**kwargs):
+        with open_sqlite3_snapshot(filename, **kwargs) as connection:
+            connection.execute('select 1 from urls limit 1').fetchone()
+
+    def copy():
+        with open_temp_sqlite3(filename) as connection:
+            connection.execute('select 1 from urls limit 1').fetchone()
+
+    bench.time('snapshot_copy', copy)
+    bench.time('snapshot_readonly', snapshot)
+    bench.time('snapshot_backup', lambda: snapshot(detach=True))
+
+    with open_sqlite3_snapshot(filename) as connection:
+        bench.time('query_count', lambda: _count(
+            query_history(make_args(), connection, HISTORY_QUERY)))
+        bench.time('query_all', lambda: _count(
+            query_history(make_args(all=True), connection, HISTORY_QUERY)))
+        bench.memory('load_tuples', lambda: query_history(
+            make_args(all=True), connection, HISTORY_QUERY).fetchall())
+        data = query_history(make_args(all=True), connection,
+                             HISTORY_QUERY).fetchall()
+
+    history = HistoryData()
+    bench.time('diff_new', lambda: len(HistoryData().get_difference(data)))
+    history.get_difference(data)
+    bench.time('diff_seen', lambda: len(history.get_difference(data)) or
+               len(data))
+
+    for output_format in inspect_history.FORMATS:
+        args = make_args(all=True, format=output_format, output=devnull)
+        bench.time('print_' + output_format,
+                   lambda: print_data_from_tuple(args, data) or len(data))
+    del data
+
+    # --follow: a refresh after new_visits visits, as print_history does it.
+    with open_sqlite3_snapshot(filename) as connection:
+        watermark = connection.execute(
+            'select max(id), max(last_visit_time) from urls').fetchone()
+
+    with tempfile.TemporaryDirectory() as directory:
+        following = os.path.join(directory, 'History')
+        state = {}
+
+        def setup():
+            with open_temp_sqlite3(filename) as connection, \
+                    sqlite3.connect(following) as copy_connection:
+                connection.backup(copy_connection)
+            copy_connection.close()
+
+            # What the first print_history() of --follow leaves behind.
+            history = state['history'] = HistoryData()
+            history.watermark = watermark
+            with open_sqlite3_snapshot(following) as connection:
+                history.get_difference(
+                    query_history_since(connection, watermark))
+            history.forget_old()
+
+            add_visits(following, new_visits, watermark[0] + 1,
+                       watermark[1] + 1)
+
+        def refresh():
+            args = make_args(output=devnull)
+            history = state['history']
+            with open_sqlite3_snapshot(following) as connection:
+                new = history.get_difference(
+                    query_history_since(connection, history.watermark))
+            print_data_from_tuple(args, new, header=False)
+            history.forget_old()
+            return len(new)
+
+        bench.time('follow_refresh_{}'.format(new_visits), refresh, setup)
+
+    devnull.close()
+
+
+def main(argv):
+    """Program entry point"""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark inspect_history on synthetic History files')
+    parser.add_argument('--sizes',
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        default=[10000, 1000000, 10000000],
+                        help='comma separated numbers of urls to test with')
+    parser.add_argument('--dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'inspect_history_bench'),
+                        help='where to keep the generated History files')
+    parser.add_argument('--repeat',
+                        type=int, default=3,
+                        help='runs per stage; the fastest is reported')
+    parser.add_argument('--new-visits',
+                        type=int, default=100,
+                        help='visits to add before timing a --follow refresh')
+    args = parser.parse_args(argv[1:])
+
+    os.makedirs(args.dir, exist_ok=True)
+    for rows in args.sizes:
+        bench_history(get_history(args.dir, rows), rows, args.repeat,
+                      args.new_visits, sys.stdout)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
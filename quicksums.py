@@ -2,7 +2,13 @@
 
 import argparse
 import hashlib
+import os
+import sqlite3
 import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
 
 HASHERS = [
@@ -13,31 +19,270 @@ HASHERS = [
 
 WIDTH = max(len(hsh.__name__.removeprefix("openssl_")) for hsh in HASHERS)
 
+CHUNK_SIZE = 1 << 20
+
+CACHE_FILE = (Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") /
+              "quicksums.sqlite3")
+
+
+def hash_file(file, chunk_size=CHUNK_SIZE):
+    """Return [(hasher name, hex digest), ...] of file for every one of
+    HASHERS, reading the file once, a chunk at a time into the same buffer,
+    so that memory use doesn't grow with the size of the file."""
+    hashers = [hasher() for hasher in HASHERS]
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    with open(file, "rb", buffering=0) as stream:
+        while size := stream.readinto(buffer):
+            chunk = view[:size]
+            for hasher in hashers:
+                hasher.update(chunk)
+
+    return [(hasher_function.__name__.removeprefix("openssl_"),
+             hasher.hexdigest())
+            for hasher_function, hasher in zip(HASHERS, hashers)]
+
+
+def walk(directory):
+    """Yield the path of every regular file under directory, recursively,
+    in name order within each directory. Symlinks aren't followed."""
+    try:
+        with os.scandir(directory) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except OSError as exc:
+        print(f"{directory}: {exc}", file=sys.stderr)
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path
+
+
+class DigestCache:
+    """Digests of files in an SQLite database, keyed by the files' (device,
+    inode, size, mtime_ns), so that a file is only hashed again once it's
+    been changed (or replaced).
+
+    Every row also records the file's path and when a run last saw it, so
+    that prune() can drop the rows of files that were changed or deleted.
+
+    Attributes:
+        hits (int): files whose digests were found in the cache
+        misses (int): files that had to be hashed
+        bytes_skipped (int): total size of the hits
+        pruned (int): rows deleted by prune()
+    """
+
+    def __init__(self, filename, commit_every=1000):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "create table if not exists digests ("
+            "dev integer, ino integer, size integer, mtime_ns integer, "
+            "hasher text, digest text, path text, last_seen integer, "
+            "primary key (dev, ino, size, mtime_ns, hasher))")
+        self.commit_every = commit_every
+        self.run = time.time_ns()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_skipped = 0
+        self.pruned = 0
+        self._pending = 0
+
+    @staticmethod
+    def key(file):
+        """Return the cache key of file as it is now."""
+        stat = os.stat(file)
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, key, file):
+        """Return hash_file()'s result for file, whose key is key, or None if
+        the cache doesn't have every one of HASHERS for it."""
+        found = dict(self.connection.execute(
+            "select hasher, digest from digests "
+            "where dev = ? and ino = ? and size = ? and mtime_ns = ?", key))
+        names = [hasher.__name__.removeprefix("openssl_")
+                 for hasher in HASHERS]
+        if not all(name in found for name in names):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_skipped += key[2]
+        self.connection.execute(
+            "update digests set path = ?, last_seen = ? "
+            "where dev = ? and ino = ? and size = ? and mtime_ns = ?",
+            (os.path.abspath(file), self.run, *key))
+        self._written()
+        return [(name, found[name]) for name in names]
+
+    def put(self, key, file, digests):
+        """Remember hash_file()'s result for file, whose key is key."""
+        self.connection.executemany(
+            "insert or replace into digests values (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*key, name, digest, os.path.abspath(file), self.run)
+             for name, digest in digests])
+        self._written()
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def prune(self, directories):
+        """Delete the rows of files under directories that this run didn't
+        see, ie. files that have been changed or deleted since they were
+        cached. Only call it once every file under directories has been
+        looked up."""
+        for directory in directories:
+            directory = os.path.join(os.path.abspath(directory), "")
+            self.pruned += self.connection.execute(
+                "delete from digests where last_seen < ? "
+                "and substr(path, 1, ?) = ?",
+                (self.run, len(directory), directory)).rowcount
+        self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def summary(self):
+        """Return a line about how much the cache saved."""
+        files = self.hits + self.misses
+        hit_rate = 100 * self.hits / files if files else 0
+        return (f"cache: {self.hits} hits, {self.misses} misses "
+                f"({hit_rate:.1f}% hit rate), "
+                f"{self.bytes_skipped:,} bytes skipped, "
+                f"{self.pruned} stale rows pruned")
+
+
+def _result(file, future):
+    try:
+        return file, future.result()
+    except OSError as exc:
+        return file, exc
+
+
+def _unchanged(file, key):
+    try:
+        return DigestCache.key(file) == key
+    except OSError:
+        return False
+
+
+def hash_files(files, jobs=1, cache=None):
+    """Yield (file, digests) for every one of files, in order, hashing up to
+    jobs files at once on a thread pool (hashlib releases the GIL while it
+    hashes, and so do reads). digests is hash_file()'s result, or the
+    OSError it raised.
+
+    At most 2 * jobs files are in flight, so memory use is bounded by that
+    many buffers however many files there are, and a slow file holds up the
+    output but not the hashing of the ones after it.
+
+    With a DigestCache, files it has digests for aren't read at all, and
+    the digests of the others are added to it.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        in_flight = deque()
+
+        def finish():
+            file, key, future = in_flight.popleft()
+            file, digests = _result(file, future)
+            # Don't cache what might be a mix of before and after a change.
+            if (key is not None and not isinstance(digests, Exception)
+                    and _unchanged(file, key)):
+                cache.put(key, file, digests)
+            return file, digests
+
+        for file in files:
+            key = digests = None
+            if cache is not None:
+                try:
+                    key = DigestCache.key(file)
+                    digests = cache.get(key, file)
+                except OSError as exc:
+                    digests = exc
+
+            if digests is None:
+                future = executor.submit(hash_file, file)
+            else:
+                key = None
+                future = Future()
+                if isinstance(digests, Exception):
+                    future.set_exception(digests)
+                else:
+                    future.set_result(digests)
+
+            in_flight.append((file, key, future))
+            if len(in_flight) >= 2 * jobs:
+                yield finish()
+
+        while in_flight:
+            yield finish()
+
 
 def main():
     parser = argparse.ArgumentParser(description="Hash some files.")
     parser.add_argument("files",
-                        nargs=argparse.ONE_OR_MORE,
+                        nargs=argparse.ZERO_OR_MORE,
                         help=("files to hash"))
+    parser.add_argument("-r", "--recursive",
+                        action="append",
+                        default=[],
+                        metavar="DIR",
+                        help=("hash every file under DIR, using the digest "
+                              "cache"))
+    parser.add_argument("--cache",
+                        default=CACHE_FILE,
+                        help=(f"digest cache for -r (default: {CACHE_FILE}); "
+                              "rows for files under DIR that were changed "
+                              "or deleted are pruned after each complete "
+                              "run"))
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        default=1,
+                        help=("number of files to hash at once"))
     args = parser.parse_args()
 
-    for file in args.files:
-        try:
-            contents = Path(file).read_bytes()
-        except FileNotFoundError as exc:
-            print(f"{file}: {exc}", file=sys.stderr)
-            continue
+    if not args.files and not args.recursive:
+        parser.error("no files or directories to hash")
+
+    files = args.files
+    cache = None
+    if args.recursive:
+        files = chain(files, (file for directory in args.recursive
+                              for file in walk(directory)))
+        cache = DigestCache(args.cache)
+
+    try:
+        for file, digests in hash_files(files, max(1, args.jobs), cache):
+            if isinstance(digests, OSError):
+                print(f"{file}: {digests}", file=sys.stderr)
+                continue
+
+            print(f"{file}\n{'=' * len(file)}")
 
-        print(f"{file}\n{'=' * len(file)}")
+            for hasher_name, digest in digests:
+                padding = " " * (WIDTH - len(hasher_name) + 1)
 
-        for hasher in HASHERS:
-            hasher_name = hasher.__name__.removeprefix("openssl_")
-            padding = " " * (WIDTH - len(hasher_name) + 1)
-            digest = hasher(contents).hexdigest()
+                print(f"{hasher_name}:{padding}{digest}")
 
-            print(f"{hasher_name}:{padding}{digest}")
+            print()
 
-        print()
+        if cache is not None:
+            cache.prune(args.recursive)
+    finally:
+        if cache is not None:
+            cache.close()
+            print(cache.summary(), file=sys.stderr)
 
 
 if __name__ == "__main__":
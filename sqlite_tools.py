@@ -7,20 +7,60 @@ scenarios.
 """
 
 import os
+import atexit
+import asyncio
+import functools
 import shutil
+import logging
 import tempfile
 import sqlite3
+import threading
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from pathlib import Path
 
+_log = logging.getLogger(__name__)
+
+
+class SnapshotConnection(sqlite3.Connection):
+    """An sqlite3.Connection that remembers how its snapshot was taken.
+
+    Attributes:
+        strategy (str): One of 'readonly' (the live file opened read-only
+            inside a read transaction), 'backup' (the live file copied into
+            memory with the online backup API) or 'copy' (the file copied to
+            a temporary directory).
+    """
+    strategy = None
+
+
+def _copy_to_temp(filename):
+    """Copy filename into a new temporary directory.
+
+    Return (tuple): the temporary directory and the copy's filename.
+    """
+    tmp_filepath = tempfile.mkdtemp()
+    tmp_filename = os.path.join(tmp_filepath, os.path.basename(filename))
+
+    try:
+        shutil.copyfile(filename, tmp_filename)
+    except (IOError, shutil.SameFileError) as error:
+        # Consider this unrecoverable for now.
+        shutil.rmtree(tmp_filepath)
+        raise error
+
+    return tmp_filepath, tmp_filename
 
 @contextmanager
-def open_temp_sqlite3(filename, query=None):
+def open_temp_sqlite3(filename, query=None, check_same_thread=True):
     """Context manager for reading an sqlite3 database while it's in use.
 
     Args:
         filename (str): The filename of the databse which we want to open
         query (str): The query to run on that databse (optional)
+        check_same_thread (bool): Passed on to sqlite3.connect()
 
     Yield:
         if query is None:
@@ -30,28 +70,345 @@ def open_temp_sqlite3(filename, query=None):
             A cursor object with the result of query.
     """
     # "Open..."
-    tmp_filepath = tempfile.mkdtemp()
-    tmp_filename = os.path.join(tmp_filepath, os.path.basename(filename))
+    tmp_filepath, tmp_filename = _copy_to_temp(filename)
+
+    connection = sqlite3.connect(tmp_filename,
+                                 check_same_thread=check_same_thread,
+                                 factory=SnapshotConnection)
+    connection.strategy = 'copy'
 
+    # "Yield..."
     try:
-        shutil.copyfile(filename, tmp_filename)
-    except (IOError, shutil.SameFileError) as error:
-        # Consider this unrecoverable for now.
+        if query is None:
+            yield connection
+        else:
+            cursor = connection.execute(query)
+            yield cursor
+
+    # "Close..."
+    finally:
+        connection.close()
         shutil.rmtree(tmp_filepath)
-        raise error
 
-    connection = sqlite3.connect(tmp_filename)
+class SnapshotCache(object):
+    """Least recently used cache of temporary copies of sqlite3 databases.
 
-    # "Yield..."
-    if query is None:
-        yield connection
-    else:
-        cursor = connection.execute(query)
-        yield cursor
+    A copy (and the connection open on it) is reused for as long as its
+    source file's (size, mtime_ns, inode) stays the same. Copies are evicted
+    once there are more than max_entries of them or they take up more than
+    max_bytes, and all of them are deleted when the interpreter exits.
 
-    # "Close..."
-    connection.close()
-    shutil.rmtree(tmp_filepath)
+    Connections handed out by acquire() are shared and stay open: don't close
+    them, and hand each one back with release() once done with it. A copy is
+    never evicted while it's acquired, so the cache may grow past its limits
+    for as long as more copies than that are in use at once.
+
+    Attributes:
+        hits (int): number of acquire() calls answered by an existing copy
+        misses (int): number of acquire() calls that had to copy the file
+    """
+    def __init__(self, max_entries=8, max_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key: [stamp, tmp_filepath, connection, pins, key]
+        self._entries = OrderedDict()
+        # id(connection): the entry of every acquired connection, including
+        # ones replaced by a newer copy but not released yet.
+        self._acquired = {}
+        self._lock = threading.Lock()
+        atexit.register(self.clear)
+
+    @staticmethod
+    def _stamp(filename):
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def _pin(self, entry):
+        entry[3] += 1
+        self._acquired[id(entry[2])] = entry
+        return entry[2]
+
+    def acquire(self, filename):
+        """Return a connection to an up to date copy of filename, which
+        stays open until it's release()d."""
+        key = os.path.realpath(filename)
+        stamp = self._stamp(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._pin(entry)
+            self.misses += 1
+
+        # Copy outside the lock so that other files can be served meanwhile.
+        tmp_filepath, tmp_filename = _copy_to_temp(key)
+        connection = sqlite3.connect(tmp_filename, check_same_thread=False,
+                                     factory=SnapshotConnection)
+        connection.strategy = 'copy'
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                # Another thread made the same copy meanwhile. Keep theirs,
+                # someone may already be using it.
+                connection.close()
+                shutil.rmtree(tmp_filepath, ignore_errors=True)
+                return self._pin(entry)
+            if entry is not None:
+                # Out of date: it goes as soon as nobody's using it.
+                self._remove(key)
+            entry = self._entries[key] = [stamp, tmp_filepath, connection, 0,
+                                          key]
+            self._pin(entry)
+            self._shrink()
+
+        return connection
+
+    def release(self, connection):
+        """Hand back a connection from acquire()."""
+        with self._lock:
+            entry = self._acquired[id(connection)]
+            entry[3] -= 1
+            if entry[3] == 0:
+                del self._acquired[id(connection)]
+                if self._entries.get(entry[4]) is not entry:
+                    self._close(entry)
+                else:
+                    self._shrink()
+
+    def _shrink(self):
+        """Evict the least recently used copies nobody's using until the
+        cache is back within its limits (or only copies in use are left)."""
+        for key in list(self._entries):
+            if (len(self._entries) <= self.max_entries and
+                    sum(entry[0][0] for entry in self._entries.values()) <=
+                    self.max_bytes):
+                return
+            if self._entries[key][3] == 0 and len(self._entries) > 1:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if entry[3] == 0:
+            self._close(entry)
+
+    @staticmethod
+    def _close(entry):
+        _, tmp_filepath, connection, _, _ = entry
+        connection.close()
+        shutil.rmtree(tmp_filepath, ignore_errors=True)
+
+    def clear(self):
+        """Close and delete every cached copy."""
+        with self._lock:
+            if self.hits or self.misses:
+                _log.info('Snapshot cache: %d hits, %d misses', self.hits,
+                          self.misses)
+            while self._entries:
+                self._close(self._entries.popitem(last=False)[1])
+            self._acquired.clear()
+
+SNAPSHOT_CACHE = SnapshotCache()
+
+@contextmanager
+def open_cached_sqlite3(filename, query=None, cache=SNAPSHOT_CACHE):
+    """Context manager like open_temp_sqlite3(), except the copy is taken
+    from cache and only made again if filename has changed since.
+
+    The copy is kept from being evicted until the context exits, and the
+    connection is left open then for the next caller to reuse.
+    """
+    connection = cache.acquire(filename)
+    try:
+        if query is None:
+            yield connection
+        else:
+            yield connection.execute(query)
+    finally:
+        cache.release(connection)
+
+def _open_readonly(filename, detach=False, check_same_thread=True):
+    """Accessory to open_sqlite3_snapshot().
+
+    Open filename through a read-only URI and take a SHARED lock on it so that
+    every query made on the returned connection sees the same snapshot. If
+    detach is True, the snapshot is instead copied into memory with the online
+    backup API and the lock on filename is released straight away.
+
+    Raise sqlite3.OperationalError if the database is locked by its writer.
+    """
+    uri = Path(filename).resolve().as_uri() + '?mode=ro'
+
+    # timeout=0: a locked database should fall back to copying right away
+    # instead of waiting five seconds for the writer to go away.
+    connection = sqlite3.connect(uri, uri=True, timeout=0,
+                                 isolation_level=None,
+                                 check_same_thread=check_same_thread,
+                                 factory=SnapshotConnection)
+    try:
+        connection.execute('begin')
+        connection.execute('select count(*) from sqlite_master').fetchone()
+    except sqlite3.Error:
+        connection.close()
+        raise
+
+    if not detach:
+        connection.strategy = 'readonly'
+        return connection
+
+    memory = sqlite3.connect(':memory:', check_same_thread=check_same_thread,
+                             factory=SnapshotConnection)
+    try:
+        connection.backup(memory)
+    except sqlite3.Error:
+        memory.close()
+        raise
+    finally:
+        connection.close()
+
+    memory.strategy = 'backup'
+    return memory
+
+@contextmanager
+def open_sqlite3_snapshot(filename, query=None, detach=False, cache=None,
+                          check_same_thread=True):
+    """Context manager for reading a consistent snapshot of an sqlite3
+    database while it's in use, without copying it when possible.
+
+    The live file is opened read-only and held in a read transaction for the
+    life of the context, so the writer can't change it under our feet. Only
+    if the writer holds the file locked (Chrome does, while it's running) do
+    we fall back to open_temp_sqlite3() and its full copy.
+
+    Args:
+        filename (str): The filename of the database which we want to open
+        query (str): The query to run on that database (optional)
+        detach (bool): Copy the snapshot into memory with the online backup
+            API rather than holding a lock on filename while the context is
+            open. Useful for long-lived snapshots.
+        cache (SnapshotCache): If given, fall back to open_cached_sqlite3()
+            with this cache rather than making a fresh copy every time.
+        check_same_thread (bool): Passed on to sqlite3.connect(). Cached
+            connections never check.
+
+    Yield:
+        Same as open_temp_sqlite3(). The strategy that was used is available
+        as connection.strategy (or cursor.connection.strategy).
+    """
+    try:
+        connection = _open_readonly(filename, detach=detach,
+                                    check_same_thread=check_same_thread)
+    except sqlite3.OperationalError as error:
+        _log.info('Unable to open %s in place (%s), using a copy', filename,
+                  error)
+        if cache is None:
+            with open_temp_sqlite3(filename, query=query,
+                                   check_same_thread=check_same_thread) \
+                    as result:
+                yield result
+        else:
+            with open_cached_sqlite3(filename, query, cache) as result:
+                yield result
+        return
+
+    _log.info('Opened %s using the %s strategy', filename,
+              connection.strategy)
+
+    try:
+        if query is None:
+            yield connection
+        else:
+            yield connection.execute(query)
+    finally:
+        connection.close()
+
+class AsyncSnapshot(object):
+    """Async context manager for open_sqlite3_snapshot().
+
+    Opening the snapshot (and copying the file, if it comes to that),
+    running queries and fetching rows all happen on an executor, so the
+    event loop is free to work on other databases meanwhile:
+
+        async with AsyncSnapshot(filename) as snapshot:
+            async for rows in snapshot.execute('select * from urls'):
+                ...
+
+    By default every snapshot gets a thread of its own. Pass executor to
+    share a pool between snapshots instead.
+    """
+    def __init__(self, filename, detach=False, cache=None, executor=None,
+                 batch_size=1000):
+        """Remember what to open; nothing happens until async with.
+
+        Args:
+            filename (str): The filename of the database to open
+            detach (bool): See open_sqlite3_snapshot()
+            cache (SnapshotCache): See open_sqlite3_snapshot()
+            executor (concurrent.futures.Executor): Where to run the blocking
+                calls. A single thread of our own if None.
+            batch_size (int): Rows per batch yielded by execute()
+        """
+        self.filename = filename
+        self.detach = detach
+        self.cache = cache
+        self.batch_size = batch_size
+        self.connection = None
+        self._executor = executor
+        self._own_executor = None
+        self._context = None
+        self._lock = asyncio.Lock()
+
+    async def _run(self, function, *args):
+        """Run function(*args) on the executor, one call at a time."""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            return await loop.run_in_executor(
+                self._executor, functools.partial(function, *args))
+
+    async def __aenter__(self):
+        if self._executor is None:
+            self._own_executor = self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='sqlite_tools')
+
+        # A shared pool may run each call on a different thread.
+        self._context = open_sqlite3_snapshot(
+            self.filename, detach=self.detach, cache=self.cache,
+            check_same_thread=self._own_executor is not None)
+        try:
+            self.connection = await self._run(self._context.__enter__)
+        except BaseException:
+            self._shutdown()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            return await self._run(self._context.__exit__, *exc_info)
+        finally:
+            self.connection = None
+            self._shutdown()
+
+    def _shutdown(self):
+        if self._own_executor is not None:
+            self._own_executor.shutdown(wait=False)
+            self._own_executor = self._executor = None
+
+    async def execute(self, query, parameters=()):
+        """Run query and asynchronously yield its rows in lists of up to
+        batch_size rows."""
+        cursor = await self._run(self.connection.execute, query, parameters)
+        try:
+            while True:
+                rows = await self._run(cursor.fetchmany, self.batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            await self._run(cursor.close)
 
 if __name__ == '__main__':
     raise ImportError('This is a module')
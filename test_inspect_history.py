@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for inspect_history.py, run with python3 -m unittest."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import inspect_history
+from inspect_history_bench import make_history
+from sqlite_tools import SNAPSHOT_CACHE
+
+
+class LockedProfilesTest(unittest.TestCase):
+    """-p all while Chrome is running: every History file is locked, so
+    each one is read from a cached copy."""
+    ROWS = 6000
+
+    def setUp(self):
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        self.home = home.name
+        userdata = os.path.join(home.name, '.config', 'google-chrome')
+
+        # More profiles than the snapshot cache keeps, each with more rows
+        # than fit on its queue, so every reader is still holding its copy
+        # open when the last copies are made.
+        self.profiles = ['Profile {}'.format(index) for index in
+                         range(SNAPSHOT_CACHE.max_entries + 2)]
+        for profile in self.profiles:
+            os.makedirs(os.path.join(userdata, profile))
+            filename = os.path.join(userdata, profile, 'History')
+            make_history(filename, self.ROWS)
+
+            lock = sqlite3.connect(filename, isolation_level=None)
+            lock.execute('begin exclusive')
+            self.addCleanup(lock.close)
+
+        self.addCleanup(SNAPSHOT_CACHE.clear)
+
+    def test_all_profiles_are_merged(self):
+        output = os.path.join(self.home, 'output.txt')
+        with mock.patch.dict(os.environ, {'HOME': self.home}):
+            status = inspect_history.main(['inspect_history.py', '-p', 'all',
+                                           '-a', '-o', output])
+        self.assertEqual(status, 0)
+        with open(output, encoding='utf-8') as lines:
+            self.assertEqual(sum(1 for _ in lines),
+                             len(self.profiles) * self.ROWS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests for sqlite_tools.py, run with python3 -m unittest."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import ExitStack
+
+from sqlite_tools import SnapshotCache, open_cached_sqlite3
+
+
+def make_database(filename, rows):
+    with sqlite3.connect(filename) as connection:
+        connection.execute('create table numbers (n integer)')
+        connection.executemany('insert into numbers values (?)',
+                               ((n,) for n in range(rows)))
+    connection.close()
+
+
+class SnapshotCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filenames = []
+        for index in range(5):
+            filename = os.path.join(directory.name, 'db{}'.format(index))
+            make_database(filename, 100 + index)
+            self.filenames.append(filename)
+        self.cache = SnapshotCache(max_entries=2)
+        self.addCleanup(self.cache.clear)
+
+    def test_copies_in_use_are_not_evicted(self):
+        with ExitStack() as stack:
+            cursors = [stack.enter_context(open_cached_sqlite3(
+                filename, 'select n from numbers', self.cache))
+                       for filename in self.filenames]
+            # Every copy past max_entries would have closed an earlier one.
+            for index, cursor in enumerate(cursors):
+                self.assertEqual(len(cursor.fetchall()), 100 + index)
+
+        self.assertLessEqual(len(self.cache._entries), 2)
+
+    def test_unchanged_file_is_reused(self):
+        with open_cached_sqlite3(self.filenames[0], cache=self.cache) as first:
+            pass
+        with open_cached_sqlite3(self.filenames[0], cache=self.cache) as again:
+            self.assertIs(first, again)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_changed_file_in_use_is_closed_on_release(self):
+        with open_cached_sqlite3(self.filenames[0], 'select n from numbers',
+                                 self.cache) as old:
+            with sqlite3.connect(self.filenames[0]) as connection:
+                connection.execute('insert into numbers values (-1)')
+            connection.close()
+            with open_cached_sqlite3(self.filenames[0],
+                                     'select n from numbers',
+                                     self.cache) as new:
+                self.assertEqual(len(new.fetchall()), 101)
+            self.assertEqual(len(old.fetchall()), 100)
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            old.connection.execute('select 1')
+
+
+if __name__ == '__main__':
+    unittest.main()